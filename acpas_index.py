@@ -0,0 +1,121 @@
+import os
+import numpy as np
+import pandas as pd
+
+from utilities import load_path
+from metadata_store import load_metadata
+
+## In-memory index over all performances of the dataset, e.g.
+##   index = ACPASIndex()
+##   view = index.select(source='ASAP', split='test', composer='Chopin', aligned=True)
+##   for row in view: index.paths(row)['performance_MIDI']
+indexed_columns = ['performance_id', 'piece_id', 'composer', 'source', 'split', 'aligned', 'subset']
+file_columns = [
+    'performance_MIDI',
+    'MIDI_score',
+    'performance_beat_annotation',
+    'score_beat_annotation',
+    'performance_annotation',  # annotation columns as named in the released metadata files
+    'score_annotation',
+]
+
+
+class ACPASView:
+    # a set of performances of an index, stored as sorted row positions
+
+    def __init__(self, index, positions):
+        self.index = index
+        self.positions = np.asarray(positions, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __iter__(self):
+        for position in self.positions:
+            yield self.index.rows[position]
+
+    def __and__(self, other):
+        return ACPASView(self.index, np.intersect1d(self.positions, other.positions, assume_unique=True))
+
+    def __or__(self, other):
+        return ACPASView(self.index, np.union1d(self.positions, other.positions))
+
+    def __sub__(self, other):
+        return ACPASView(self.index, np.setdiff1d(self.positions, other.positions, assume_unique=True))
+
+    def select(self, **conditions):
+        return self & self.index.select(**conditions)
+
+    @property
+    def performance_ids(self):
+        return [self.index.rows[position]['performance_id'] for position in self.positions]
+
+    @property
+    def piece_ids(self):
+        return sorted(set(self.index.rows[position]['piece_id'] for position in self.positions))
+
+    def to_frame(self):
+        return self.index.metadata.iloc[self.positions].reset_index(drop=True)
+
+
+class ACPASIndex:
+
+    def __init__(self, metadata=None):
+        if metadata is None:
+            metadata = pd.concat([load_metadata('metadata_R.csv'), load_metadata('metadata_S.csv')], ignore_index=True)
+        self.metadata = metadata.reset_index(drop=True)
+        self.metadata['subset'] = self.metadata['performance_id'].astype(str).str[0]  # "R" or "S"
+        self.rows = self.metadata.to_dict('records')
+
+        # value -> row positions, for every indexed column
+        self.indexes = {}
+        for column in indexed_columns:
+            groups = self.metadata.groupby(self.metadata[column].astype(object), sort=False, observed=True).indices
+            self.indexes[column] = dict((key, np.sort(positions)) for key, positions in groups.items())
+
+    def __len__(self):
+        return len(self.rows)
+
+    def all(self):
+        return ACPASView(self, np.arange(len(self.rows)))
+
+    def get(self, performance_id):
+        # row of a performance
+        positions = self.indexes['performance_id'].get(performance_id)
+        if positions is None:
+            raise KeyError(performance_id)
+        return self.rows[positions[0]]
+
+    def lookup(self, column, value):
+        # view of the performances with column == value
+        positions = self.indexes[column].get(value, np.zeros(0, dtype=np.int64))
+        return ACPASView(self, positions)
+
+    def select(self, **conditions):
+        # performances matching all conditions, a list of values matches any of them
+        # e.g. select(source='ASAP', split=['train', 'validation'])
+        view = self.all()
+        for column, values in conditions.items():
+            if column not in self.indexes:
+                raise ValueError('Column not indexed: {}'.format(column))
+            if not isinstance(values, (list, tuple, set)):
+                values = [values]
+            matched = ACPASView(self, np.zeros(0, dtype=np.int64))
+            for value in values:
+                matched = matched | self.lookup(column, value)
+            view = view & matched
+        return view
+
+    def pieces(self, piece_id):
+        return self.lookup('piece_id', piece_id)
+
+    def paths(self, row):
+        # paths to the files of a performance (row or performance_id)
+        if isinstance(row, str):
+            row = self.get(row)
+        folder = load_path(row['folder'])
+        paths = {'performance_audio': os.path.join('audio_files', folder, row['performance_audio'])}
+        for column in file_columns:
+            if column in row:
+                paths[column] = os.path.join(folder, row[column])
+        return paths
@@ -0,0 +1,132 @@
+import os
+import numpy as np
+
+from utilities import file_hash, atomic_write
+
+## Beat annotation files (time \t label per beat, label "b"/"db"/"bR" for
+## beat/downbeat/beat with repeat, then optionally ",<time signature>" and
+## ",<key signature in sharps>", e.g. "db,3/4,-2" or "b,,0") as typed arrays:
+##   times            float64 beat times
+##   beat_types       index into beat_types
+##   downbeats        downbeat mask
+##   time_signatures  (index, time, numerator, denominator) of the changes
+##   key_signatures   (index, time, sharps) of the changes
+## Parsed files are cached as .npy sidecars (one record per beat) keyed by
+## file content, and format_annotation writes the TSV back byte for byte.
+ANNOTATION_CACHE_DIR = os.path.join('.cache', 'annotations')
+ANNOTATION_CACHE_VERSION = 1
+
+beat_types = ['b', 'db', 'bR']
+beat_dtype = np.dtype([
+    ('time', 'f8'),
+    ('beat_type', 'u1'),
+    ('numerator', 'u1'),  # time signature change on this beat, 0 if none
+    ('denominator', 'u1'),
+    ('key_change', '?'),  # key signature change on this beat
+    ('sharps', 'i1'),  # negative for flats
+])
+annotation_time_signature_dtype = np.dtype([
+    ('index', 'i8'),  # beat of the change
+    ('time', 'f8'),
+    ('numerator', 'u1'),
+    ('denominator', 'u1'),
+])
+annotation_key_signature_dtype = np.dtype([
+    ('index', 'i8'),
+    ('time', 'f8'),
+    ('sharps', 'i1'),
+])
+
+def annotation_arrays(beats):
+    # annotation dict from the per-beat records
+    time_signature_index = np.flatnonzero(beats['numerator'] > 0)
+    time_signatures = np.zeros(len(time_signature_index), dtype=annotation_time_signature_dtype)
+    time_signatures['index'] = time_signature_index
+    for field in ['time', 'numerator', 'denominator']:
+        time_signatures[field] = beats[field][time_signature_index]
+
+    key_signature_index = np.flatnonzero(beats['key_change'])
+    key_signatures = np.zeros(len(key_signature_index), dtype=annotation_key_signature_dtype)
+    key_signatures['index'] = key_signature_index
+    for field in ['time', 'sharps']:
+        key_signatures[field] = beats[field][key_signature_index]
+
+    return {
+        'beats': beats,
+        'times': beats['time'],
+        'beat_types': beats['beat_type'],
+        'downbeats': beats['beat_type'] == beat_types.index('db'),
+        'time_signatures': time_signatures,
+        'key_signatures': key_signatures,
+    }
+
+def parse_labels(times, labels):
+    # annotation dict from beat times and label strings
+    beats = np.zeros(len(labels), dtype=beat_dtype)
+    beats['time'] = times
+    for i, label in enumerate(labels):
+        fields = label.split(',')
+        beats['beat_type'][i] = beat_types.index(fields[0])
+        if len(fields) > 1 and fields[1] != '':
+            numerator, denominator = fields[1].split('/')
+            beats['numerator'][i], beats['denominator'][i] = int(numerator), int(denominator)
+        if len(fields) > 2 and fields[2] != '':
+            beats['key_change'][i], beats['sharps'][i] = True, int(fields[2])
+
+    annotation = annotation_arrays(beats)
+    # keep labels in a form the records do not cover verbatim, so the file can still be written back as is
+    if annotation_labels(annotation) != list(labels):
+        annotation['labels'] = list(labels)
+    return annotation
+
+def annotation_labels(annotation):
+    # label strings of all beats
+    if 'labels' in annotation:
+        return annotation['labels']
+    labels = []
+    for _, beat_type, numerator, denominator, key_change, sharps in annotation['beats'].tolist():
+        time_signature = '{}/{}'.format(numerator, denominator) if numerator else ''
+        if key_change:
+            labels.append(','.join([beat_types[beat_type], time_signature, str(sharps)]))
+        elif time_signature:
+            labels.append(','.join([beat_types[beat_type], time_signature]))
+        else:
+            labels.append(beat_types[beat_type])
+    return labels
+
+def parse_annotation(text, time_column=0, label_column=1):
+    # annotation dict from the text of a TSV file (time_column/label_column for other layouts,
+    # e.g. 1/2 for the ASAP annotation files)
+    times, labels = [], []
+    for line in text.splitlines():
+        fields = line.split('\t')
+        times.append(float(fields[time_column]))
+        labels.append(fields[label_column])
+    return parse_labels(times, labels)
+
+def format_annotation(annotation):
+    # TSV text, as written by pandas to_csv(sep='\t', header=None, index=False)
+    times = annotation['times'].tolist()
+    return ''.join('{!r}\t{}\n'.format(time, label) for time, label in zip(times, annotation_labels(annotation)))
+
+def cache_file(annotation_file, time_column, label_column, cache_dir=ANNOTATION_CACHE_DIR):
+    key = '{}_{}{}_v{}'.format(file_hash(annotation_file), time_column, label_column, ANNOTATION_CACHE_VERSION)
+    return os.path.join(cache_dir, key[:2], key + '.npy')
+
+def read_annotation(annotation_file, time_column=0, label_column=1, cache_dir=ANNOTATION_CACHE_DIR):
+    # parsed annotation file, from the sidecar if possible
+    cached = cache_file(annotation_file, time_column, label_column, cache_dir)
+    if os.path.exists(cached):
+        return annotation_arrays(np.load(cached))
+    with open(annotation_file) as f:
+        annotation = parse_annotation(f.read(), time_column, label_column)
+    if 'labels' not in annotation:
+        atomic_write(cached, lambda tmp: np.save(tmp, annotation['beats']), suffix='.npy')
+    return annotation
+
+def write_annotation(annotation_file, annotation):
+    # atomic, files shared by several performances (ASAP score annotations) may be written by concurrent workers
+    def write(tmp):
+        with open(tmp, 'w', newline='') as f:
+            f.write(format_annotation(annotation))
+    atomic_write(annotation_file, write)
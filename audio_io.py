@@ -0,0 +1,135 @@
+import struct
+import numpy as np
+
+## Audio access without decoding: durations come from the WAV/FLAC headers,
+## and uncompressed WAV samples are memory-mapped from the offset given in
+## the header. Resampling, when needed, is done per window/block.
+WAVE_FORMAT_PCM = 1
+WAVE_FORMAT_IEEE_FLOAT = 3
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+def read_wav_header(path):
+    # dict with format, channels, sample_rate, bits_per_sample, data_offset, data_size
+    with open(path, 'rb') as f:
+        riff, _, wave = struct.unpack('<4sI4s', f.read(12))
+        if riff not in (b'RIFF', b'RF64') or wave != b'WAVE':
+            raise ValueError('Not a WAV file: {}'.format(path))
+        header = {}
+        while True:
+            chunk = f.read(8)
+            if len(chunk) < 8:
+                raise ValueError('No data chunk in WAV file: {}'.format(path))
+            chunk_id, chunk_size = struct.unpack('<4sI', chunk)
+            if chunk_id == b'fmt ':
+                fmt = f.read(chunk_size)
+                audio_format, channels, sample_rate, _, _, bits_per_sample = struct.unpack('<HHIIHH', fmt[:16])
+                if audio_format == WAVE_FORMAT_EXTENSIBLE and len(fmt) >= 26:
+                    audio_format = struct.unpack('<H', fmt[24:26])[0]  # first two bytes of the sub-format GUID
+                header.update(format=audio_format, channels=channels, sample_rate=sample_rate, bits_per_sample=bits_per_sample)
+            elif chunk_id == b'data':
+                header.update(data_offset=f.tell(), data_size=chunk_size)
+                return header
+            else:
+                f.seek(chunk_size + (chunk_size & 1), 1)  # chunks are word aligned
+
+def wav_dtype(header):
+    if header['format'] == WAVE_FORMAT_PCM and header['bits_per_sample'] in (8, 16, 32):
+        return np.dtype({8: 'u1', 16: '<i2', 32: '<i4'}[header['bits_per_sample']])
+    if header['format'] == WAVE_FORMAT_IEEE_FLOAT and header['bits_per_sample'] in (32, 64):
+        return np.dtype({32: '<f4', 64: '<f8'}[header['bits_per_sample']])
+    raise ValueError('WAV sample format cannot be memory-mapped: format {}, {} bits'.format(header['format'], header['bits_per_sample']))
+
+def load_wav_mmap(path):
+    # (samples as a read-only memmap of shape (n_samples, channels), sample rate)
+    header = read_wav_header(path)
+    dtype = wav_dtype(header)
+    n_samples = header['data_size'] // (dtype.itemsize * header['channels'])
+    samples = np.memmap(path, dtype=dtype, mode='r', offset=header['data_offset'], shape=(n_samples, header['channels']))
+    return samples, header['sample_rate']
+
+def to_float(samples):
+    # integer PCM samples to float32 in [-1, 1)
+    if samples.dtype.kind == 'f':
+        return samples.astype(np.float32)
+    if samples.dtype == np.uint8:
+        return (samples.astype(np.float32) - 128) / 128
+    return samples.astype(np.float32) / np.iinfo(samples.dtype).max
+
+def read_flac_streaminfo(path):
+    # dict with sample_rate, channels, bits_per_sample, total_samples
+    with open(path, 'rb') as f:
+        if f.read(4) != b'fLaC':
+            raise ValueError('Not a FLAC file: {}'.format(path))
+        block_header = f.read(4)
+        if block_header[0] & 0x7F != 0:
+            raise ValueError('FLAC file does not start with STREAMINFO: {}'.format(path))
+        info = f.read(34)
+    bits = int.from_bytes(info[10:18], 'big')
+    return {
+        'sample_rate': bits >> 44,
+        'channels': ((bits >> 41) & 0x7) + 1,
+        'bits_per_sample': ((bits >> 36) & 0x1F) + 1,
+        'total_samples': bits & 0xFFFFFFFFF,
+    }
+
+def audio_duration(path):
+    # duration in seconds from the file header, no decoding
+    with open(path, 'rb') as f:
+        magic = f.read(4)
+    if magic == b'fLaC':
+        info = read_flac_streaminfo(path)
+        return info['total_samples'] / info['sample_rate']
+    header = read_wav_header(path)
+    block_align = header['channels'] * header['bits_per_sample'] // 8
+    return header['data_size'] // block_align / header['sample_rate']
+
+def resample(samples, sample_rate, target_sample_rate):
+    # resample along the first axis, with scipy's polyphase filter if available
+    if sample_rate == target_sample_rate:
+        return samples
+    try:
+        from math import gcd
+        from scipy.signal import resample_poly
+        g = gcd(int(sample_rate), int(target_sample_rate))
+        return resample_poly(samples, target_sample_rate // g, sample_rate // g, axis=0).astype(np.float32)
+    except ImportError:
+        # linear interpolation
+        n_target = int(round(len(samples) * target_sample_rate / sample_rate))
+        positions = np.arange(n_target) * sample_rate / target_sample_rate
+        return np.stack([np.interp(positions, np.arange(len(samples)), samples[:, c]) for c in range(samples.shape[1])], axis=1).astype(np.float32)
+
+def load_window(path, start, end, sample_rate=None):
+    # float32 samples between start and end seconds, only this window is read and resampled
+    samples, file_sample_rate = load_wav_mmap(path)
+    window = to_float(samples[int(round(start * file_sample_rate)):int(round(end * file_sample_rate))])
+    if sample_rate is not None:
+        window = resample(window, file_sample_rate, sample_rate)
+    return window
+
+def iterate_blocks(path, block_seconds=60., sample_rate=None):
+    # whole file as consecutive float32 blocks, resampled block by block
+    samples, file_sample_rate = load_wav_mmap(path)
+    block_samples = int(round(block_seconds * file_sample_rate))
+    for start in range(0, len(samples), block_samples):
+        block = to_float(samples[start:start+block_samples])
+        if sample_rate is not None:
+            block = resample(block, file_sample_rate, sample_rate)
+        yield block
+
+def write_wav_blocks(path, blocks, sample_rate, channels):
+    # 16-bit PCM WAV from an iterable of float blocks of shape (n_samples, channels), written
+    # block by block, the sizes in the header are filled in at the end
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<4sI4s', b'RIFF', 0, b'WAVE'))
+        f.write(struct.pack('<4sIHHIIHH', b'fmt ', 16, WAVE_FORMAT_PCM, channels, sample_rate,
+                            sample_rate * channels * 2, channels * 2, 16))
+        f.write(struct.pack('<4sI', b'data', 0))
+        data_size = 0
+        for block in blocks:
+            samples = np.round(np.clip(block, -1., 1.) * 32767).astype('<i2')
+            f.write(samples.tobytes())
+            data_size += samples.nbytes
+        f.seek(4)
+        f.write(struct.pack('<I', 36 + data_size))
+        f.seek(40)
+        f.write(struct.pack('<I', data_size))
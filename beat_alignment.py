@@ -0,0 +1,44 @@
+import numpy as np
+
+from midi_cache import time_to_tick
+
+## Alignment of beat annotations to a MIDI score, for whole files at once:
+## the reference values are sorted once and the nearest neighbour of every
+## query is found with np.searchsorted (O((n + m) log n) instead of comparing
+## every annotation with every score beat).
+SUBBEAT_PHASES = np.array([0., 0.125, 0.25, 0.33333333333, 0.375, 0.5, 0.625, 0.66666666667, 0.75, 0.875, 1.])
+
+def nearest(reference, queries):
+    # (index into reference, absolute distance) of the nearest reference value of every query
+    reference = np.asarray(reference, dtype=np.float64)
+    queries = np.asarray(queries, dtype=np.float64)
+    if len(reference) == 0:
+        return np.full(len(queries), -1, dtype=np.int64), np.full(len(queries), np.inf)
+    order = np.argsort(reference, kind='stable')
+    reference = reference[order]
+    right = np.clip(np.searchsorted(reference, queries), 1, len(reference) - 1) if len(reference) > 1 else np.zeros(len(queries), dtype=np.int64)
+    left = np.maximum(right - 1, 0)
+    left_distances = np.abs(reference[left] - queries)
+    right_distances = np.abs(reference[right] - queries)
+    use_right = right_distances < left_distances
+    return order[np.where(use_right, right, left)], np.where(use_right, right_distances, left_distances)
+
+def subbeat_phases(beats_in_score, phases=SUBBEAT_PHASES):
+    # (index into phases, distance) of the nearest subbeat phase of every position in beats
+    return nearest(phases, np.asarray(beats_in_score) % 1)
+
+def align_annotation(midi, annotation, phases=SUBBEAT_PHASES):
+    # per-beat alignment of a parsed beat annotation to a parsed MIDI score:
+    #   downbeat_distances  distance of every annotated downbeat to the nearest MIDI score downbeat
+    #   beats_in_score      annotated beats in score beats (ticks / resolution)
+    #   phases              index into phases of the nearest subbeat phase of every beat
+    #   phase_distances     distance to that phase
+    _, downbeat_distances = nearest(midi['downbeats'], annotation['times'][annotation['downbeats']])
+    beats_in_score = time_to_tick(midi, annotation['times']) / midi['resolution']
+    beat_phases, phase_distances = subbeat_phases(beats_in_score, phases)
+    return {
+        'downbeat_distances': downbeat_distances,
+        'beats_in_score': beats_in_score,
+        'phases': beat_phases,
+        'phase_distances': phase_distances,
+    }
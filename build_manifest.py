@@ -0,0 +1,92 @@
+import os
+import json
+import hashlib
+import inspect
+
+from utilities import file_hash, save_json
+
+## The build manifest records, for every output of a create_dataset.py stage,
+## the signatures of its inputs, the stage version and the output mtime. An
+## output is rebuilt when any of these no longer match.
+MANIFEST_FILE = os.path.join('.cache', 'build_manifest.json')
+LARGE_FILE_BYTES = 64 * 1024 ** 2  # inputs larger than this are signed by size and mtime instead of content
+
+def load_manifest(manifest_file=MANIFEST_FILE):
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            return json.load(f)
+    return {'outputs': {}, 'hashes': {}}
+
+def save_manifest(manifest, manifest_file=MANIFEST_FILE):
+    save_json(manifest_file, manifest)
+
+def stage_version(version, functions):
+    # stage version changes with the declared version or the code of the stage
+    h = hashlib.sha1(str(version).encode())
+    for func in functions:
+        h.update(inspect.getsource(func).encode())
+    return h.hexdigest()
+
+def input_signature(manifest, path):
+    # content hash of an input file, re-hashed only when its size or mtime changes
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    if stat.st_size > LARGE_FILE_BYTES:
+        return 'stat:{}:{}'.format(stat.st_size, stat.st_mtime_ns)
+    cached = manifest['hashes'].get(path)
+    if cached is not None and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+        return cached[2]
+    h = file_hash(path)
+    manifest['hashes'][path] = [stat.st_size, stat.st_mtime_ns, h]
+    return h
+
+def output_mtime(output):
+    # outputs that are not files (e.g. metadata columns) have no mtime
+    return os.stat(output).st_mtime_ns if os.path.isfile(output) else None
+
+def is_up_to_date(manifest, output, inputs, stage, version, is_file=True):
+    entry = manifest['outputs'].get(output)
+    if entry is None or entry['stage'] != stage or entry['version'] != version:
+        return False
+    if is_file and (not os.path.exists(output) or entry['mtime'] != output_mtime(output)):
+        return False  # missing, half-written or changed by hand
+    return entry['inputs'] == dict((i, input_signature(manifest, i)) for i in inputs)
+
+def record_output(manifest, output, inputs, stage, version, is_file=True):
+    manifest['outputs'][output] = {
+        'stage': stage,
+        'version': version,
+        'inputs': dict((i, input_signature(manifest, i)) for i in inputs),
+        'mtime': output_mtime(output) if is_file else None,
+    }
+
+def stale_rows(manifest, metadata, targets, stage, version):
+    # mask over metadata rows with any output to rebuild
+    # targets(row) -> list of (output, inputs, is_file)
+    stale = []
+    for row in metadata.to_dict('records'):
+        stale.append(any(not is_up_to_date(manifest, output, inputs, stage, version, is_file)
+                            for output, inputs, is_file in targets(row)))
+    return stale
+
+def record_rows(manifest, metadata, targets, stage, version):
+    for row in metadata.to_dict('records'):
+        for output, inputs, is_file in targets(row):
+            record_output(manifest, output, inputs, stage, version, is_file)
+
+def stage_order(stages, dependencies):
+    # stages sorted so that every stage comes after the stages it depends on
+    ordered = []
+    def visit(stage, path):
+        if stage in path:
+            raise ValueError('Circular stage dependency: ' + ' -> '.join(path + [stage]))
+        if stage in ordered:
+            return
+        for dep in dependencies[stage]:
+            if dep in stages:
+                visit(dep, path + [stage])
+        ordered.append(stage)
+    for stage in stages:
+        visit(stage, [])
+    return ordered
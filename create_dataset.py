@@ -9,14 +9,19 @@ import numpy as np
 import matplotlib.pyplot as plt
 import random
 random.seed(42)
-import subprocess
-import time
 import pretty_midi as pm
-import mido
 from collections import defaultdict
 import functools
 
-from utilities import format_path, load_path, mkdir
+from utilities import format_path, load_path, metadata_map
+from midi_cache import load_midi, time_to_tick, tick_to_time
+from midi_scan import scan_midi
+from midi_writer import encode_track, write_midi, meta_event, note_events, control_change_events, program_change_events
+from materialize import materialize_files, materialize_modes, verify_modes
+from metadata_store import write_metadata_store
+from annotation_codec import read_annotation, write_annotation, parse_labels
+from pianoroll_store import build_pianoroll_store, store_row_pianorolls, compute_pianoroll, merge_intervals, apply_pedal, store_file, PIANOROLL_PEDAL_THRESHOLDS
+from build_manifest import load_manifest, save_manifest, stage_version, stale_rows, record_rows, stage_order
 
 Kontakt_Pianos_all = [
     'Gentleman_soft',
@@ -91,10 +96,25 @@ def get_distinct_pieces_dict(args):
 
 def update_distinct_pieces(distinct_pieces_dict):
     distinct_pieces = pd.read_csv('distinct_pieces.csv')
-    for i, row in distinct_pieces.iterrows():
-        distinct_pieces.loc[i, 'split'] = distinct_pieces_dict['id2piece'][row['id']]['split']
+    id2split = dict((piece_id, piece['split']) for piece_id, piece in distinct_pieces_dict['id2piece'].items())
+    distinct_pieces['split'] = distinct_pieces['id'].map(id2split)
     distinct_pieces.to_csv('distinct_pieces.csv', index=False)
 
+def get_piece_id2split(piece_id_test, piece_id_validation, piece_id_train):
+    piece_id2split = dict((piece_id, 'train') for piece_id in piece_id_train)
+    piece_id2split.update((piece_id, 'validation') for piece_id in piece_id_validation)
+    piece_id2split.update((piece_id, 'test') for piece_id in piece_id_test)
+    return piece_id2split
+
+def fill_missing_splits(metadata, piece_id2split):
+    # performances without a split take the split of their piece
+    missing = metadata['split'].isna()
+    metadata.loc[missing, 'split'] = metadata.loc[missing, 'piece_id'].map(piece_id2split)
+    unresolved = metadata['split'].isna()
+    if unresolved.any():
+        print('check error!', list(metadata.loc[unresolved, 'performance_id']))
+    return metadata
+
 def get_CPM_metadata_dict(args):
     CPM_metadata = pd.read_csv(os.path.join(args.CPM, 'metadata.csv'))
     CPM_metadata_dict = {
@@ -117,7 +137,7 @@ def create_real_recording_subset(distinct_pieces_dict,
                                 args):
     print('\nCreate Real recording subset...')
 
-    metadata_R = pd.DataFrame(columns=metadata_columns)
+    metadata_R_records = []  # one list per performance, in the order of metadata_columns
     performance_count = 0
 
     ## MAPS "ENSTDkCl" and "ENSTDkAm" subsets
@@ -155,7 +175,7 @@ def create_real_recording_subset(distinct_pieces_dict,
             distinct_pieces_dict['id2piece'][piece_id]['split'] = split
 
             # update metadata_R
-            metadata_R.loc[performance_count] = [
+            metadata_R_records.append([
                 performance_id,
                 composer,
                 piece_id,
@@ -175,7 +195,7 @@ def create_real_recording_subset(distinct_pieces_dict,
                 score_beat_annotation,
                 duration,
                 split,
-            ]
+            ])
             performance_count += 1
 
     ## ASAP real recording tuples
@@ -209,7 +229,7 @@ def create_real_recording_subset(distinct_pieces_dict,
             split = distinct_pieces_dict['id2piece'][piece_id]['split']  # use existing split here, update later
 
             # update metadata_R
-            metadata_R.loc[performance_count] = [
+            metadata_R_records.append([
                 performance_id,
                 composer,
                 piece_id,
@@ -229,12 +249,14 @@ def create_real_recording_subset(distinct_pieces_dict,
                 score_beat_annotation,
                 duration,
                 split,
-            ]
+            ])
             performance_count += 1
 
+    metadata_R = pd.DataFrame(metadata_R_records, columns=metadata_columns)
+
     ## udpate train/validation/test split for ASAP real recording performances
     # all pieces from ASAP
-    ASAP_piece_id_all = set([row['piece_id'] for i, row in metadata_R.iterrows() if row['source'] == 'ASAP'])
+    ASAP_piece_id_all = set(metadata_R.loc[metadata_R['source'] == 'ASAP', 'piece_id'])
     # train/validation/test amounts
     train_amount = len(ASAP_piece_id_all) * 8 // 10
     validation_amount = len(ASAP_piece_id_all) // 10
@@ -254,16 +276,8 @@ def create_real_recording_subset(distinct_pieces_dict,
     ASAP_piece_id_remaining -= ASAP_piece_id_validation
 
     # update split in metadata_R
-    for i, row in metadata_R.iterrows():
-        if type(row['split']) == float:
-            if row['piece_id'] in ASAP_piece_id_test_additional:
-                metadata_R.loc[i, 'split'] = 'test'
-            elif row['piece_id'] in ASAP_piece_id_validation:
-                metadata_R.loc[i, 'split'] = 'validation'
-            elif row['piece_id'] in ASAP_piece_id_remaining:
-                metadata_R.loc[i, 'split'] = 'train'
-            else:
-                print('check error!')
+    piece_id2split = get_piece_id2split(ASAP_piece_id_test_additional, ASAP_piece_id_validation, ASAP_piece_id_remaining)
+    metadata_R = fill_missing_splits(metadata_R, piece_id2split)
     # update split in distinct_pieces_dict
     for piece_id in distinct_pieces_dict['id2piece'].keys():
         if piece_id in ASAP_piece_id_test_additional:
@@ -280,7 +294,7 @@ def create_synthetic_subset(distinct_pieces_dict,
                             args):
     print('\nCreate Synthetic subset...')
 
-    metadata_S = pd.DataFrame(columns=metadata_columns)
+    metadata_S_records = []  # one list per performance, in the order of metadata_columns
     performance_count = 0
 
     ## MAPS Synthetic subsets
@@ -315,7 +329,7 @@ def create_synthetic_subset(distinct_pieces_dict,
             split = distinct_pieces_dict['id2piece'][piece_id]['split']  # using the existing split first and update the empty ones later
 
             # update metadata_S
-            metadata_S.loc[performance_count] = [
+            metadata_S_records.append([
                 performance_id,
                 composer,
                 piece_id,
@@ -335,7 +349,7 @@ def create_synthetic_subset(distinct_pieces_dict,
                 score_beat_annotation,
                 duration,
                 split,
-            ]
+            ])
             performance_count += 1
 
     ## ASAP performance MIDIs
@@ -367,7 +381,7 @@ def create_synthetic_subset(distinct_pieces_dict,
         split = distinct_pieces_dict['id2piece'][piece_id]['split']  # using the existing split first and update the empty ones later
 
         # update metadata_S
-        metadata_S.loc[performance_count] = [
+        metadata_S_records.append([
             performance_id,
             composer,
             piece_id,
@@ -387,7 +401,7 @@ def create_synthetic_subset(distinct_pieces_dict,
             score_beat_annotation,
             duration,
             split,
-        ]
+        ])
         performance_count += 1
 
     ## CPM performances
@@ -414,7 +428,7 @@ def create_synthetic_subset(distinct_pieces_dict,
         split = distinct_pieces_dict['id2piece'][piece_id]['split']  # using the existing split first and update the empty ones later
 
         # update metadata_S
-        metadata_S.loc[performance_count] = [
+        metadata_S_records.append([
             performance_id,
             composer,
             piece_id,
@@ -434,9 +448,11 @@ def create_synthetic_subset(distinct_pieces_dict,
             score_beat_annotation,
             duration,
             split,
-        ]
+        ])
         performance_count += 1
 
+    metadata_S = pd.DataFrame(metadata_S_records, columns=metadata_columns)
+
     ## split into train/validation and test
     piece_id_all = set(metadata_S.loc[:, 'piece_id'])
     # train/validation/test amounts
@@ -462,16 +478,8 @@ def create_synthetic_subset(distinct_pieces_dict,
         piece_id_validation_additional = {}
         
     # update split in metadata_S
-    for i, row in metadata_S.iterrows():
-        if type(row['split']) == float:
-            if row['piece_id'] in piece_id_test_additional:
-                metadata_S.loc[i, 'split'] = 'test'
-            elif row['piece_id'] in piece_id_validation_additional:
-                metadata_S.loc[i, 'split'] = 'validation'
-            elif row['piece_id'] in piece_id_remaining:
-                metadata_S.loc[i, 'split'] = 'train'
-            else:
-                print('check error!')
+    piece_id2split = get_piece_id2split(piece_id_test_additional, piece_id_validation_additional, piece_id_remaining)
+    metadata_S = fill_missing_splits(metadata_S, piece_id2split)
     # update split in distinct_pieces_dict
     for piece_id in distinct_pieces_dict['id2piece'].keys():
         if piece_id in piece_id_test_additional:
@@ -482,288 +490,366 @@ def create_synthetic_subset(distinct_pieces_dict,
             distinct_pieces_dict['id2piece'][piece_id]['split'] = 'train'
 
     ## Allocate Kontakt Piano according to the train/validation/test split
-    for i, row in metadata_S.iterrows():
-        if type(row['performance_audio_external']) == float:
-            if row['split'] == 'test':
-                piano = random.choice(Kontakt_Pianos_all)
-            else:
-                piano = random.choice(Kontakt_Pianos_train)
-            metadata_S.loc[i, 'performance_audio'] = row['performance_audio'][:-4] + '_' + piano + '.wav'
+    synthesized = metadata_S['performance_audio_external'].isna()
+    pianos = [random.choice(Kontakt_Pianos_all) if split == 'test' else random.choice(Kontakt_Pianos_train)
+                for split in metadata_S.loc[synthesized, 'split']]  # one draw per performance, in row order
+    metadata_S.loc[synthesized, 'performance_audio'] = metadata_S.loc[synthesized, 'performance_audio'].str[:-4] + '_' + pd.Series(pianos, index=metadata_S.index[synthesized]) + '.wav'
     
     return distinct_pieces_dict, metadata_S
 
 def copy_midi_files(metadata, subset, args):
     print('\nCopy midi files from external sources...', subset)
 
+    pairs = {}
     for i, row in metadata.iterrows():
-        print(i+1, '/', len(metadata), end='\r')
-
         performance_MIDI_external = load_path(row['performance_MIDI_external']).format(A_MAPS=args.A_MAPS, CPM=args.CPM, ASAP=args.ASAP)
         MIDI_score_external = load_path(row['MIDI_score_external']).format(A_MAPS=args.A_MAPS, CPM=args.CPM, ASAP=args.ASAP)
         folder = load_path(row['folder'])
         performance_MIDI_internal = os.path.join(folder, row['performance_MIDI'])
         MIDI_score_internal = os.path.join(folder, row['MIDI_score'])
-        
-        mkdir(folder)
-        if not os.path.exists(performance_MIDI_internal):
-            subprocess.check_output(['cp', performance_MIDI_external, performance_MIDI_internal])
-            time.sleep(0.02)
-        if not os.path.exists(MIDI_score_internal):
-            subprocess.check_output(['cp', MIDI_score_external, MIDI_score_internal])
-            time.sleep(0.02)
-    print()
-
-def update_performance_durations(metadata, subset):
-    print('\nUpdate performance durations...', subset)
 
-    for i, row in metadata.iterrows():
-        print(i+1, '/', len(metadata), end='\r')
+        # one entry per destination, MIDI scores can be shared between performances
+        pairs.setdefault(performance_MIDI_internal, performance_MIDI_external)
+        pairs.setdefault(MIDI_score_internal, MIDI_score_external)
 
-        performance_MIDI_internal = os.path.join(load_path(row['folder']), row['performance_MIDI'])
-        midi_data = pm.PrettyMIDI(performance_MIDI_internal)
-        duration = midi_data.get_end_time()
+    # always real copies: ASAP MIDI scores are rewritten in place later
+    materialize_files([(src, dst) for dst, src in pairs.items()], mode='copy', verify=args.verify, workers=args.io_workers)
 
-        metadata.loc[i, 'duration'] = duration
-    print()
+def get_performance_duration(row):
+    performance_MIDI_internal = os.path.join(load_path(row['folder']), row['performance_MIDI'])
+    return scan_midi(performance_MIDI_internal)['end_time']
+
+def update_performance_durations(metadata, subset, args):
+    print('\nUpdate performance durations...', subset)
+
+    durations = metadata_map(get_performance_duration, metadata, workers=args.workers, chunksize=args.chunksize)
+    metadata['duration'] = durations
 
     return metadata
 
+def get_beat_annotation(row, args):
+    performance_beat_annotation_internal = os.path.join(load_path(row['folder']), row['performance_beat_annotation'])
+    score_beat_annotation_internal = os.path.join(load_path(row['folder']), row['score_beat_annotation'])
+
+    if not os.path.exists(performance_beat_annotation_internal) or not os.path.exists(score_beat_annotation_internal):
+
+        if row['source'] == 'ASAP':  # copy annotation files
+            performance_beat_annotation_external = load_path(row['performance_beat_annotation_external']).format(ASAP=args.ASAP)
+            score_beat_annotation_external = load_path(row['score_beat_annotation_external']).format(ASAP=args.ASAP)
+
+            performance_beat_annotation = read_annotation(performance_beat_annotation_external, time_column=1, label_column=2)
+            score_beat_annotation = read_annotation(score_beat_annotation_external, time_column=1, label_column=2)
+
+            write_annotation(performance_beat_annotation_internal, performance_beat_annotation)
+            write_annotation(score_beat_annotation_internal, score_beat_annotation)
+
+        else:  # generate annotation files (performance MIDI and MIDI score are the same)
+            MIDI_file = os.path.join(load_path(row['folder']), row['performance_MIDI'])
+            midi_data = pm.PrettyMIDI(MIDI_file)
+
+            beats = midi_data.get_beats()
+            downbeats_set = set(midi_data.get_downbeats())
+            time2timesig_change = defaultdict(str, dict([(ts.time, f'{ts.numerator}/{ts.denominator}') for ts in midi_data.time_signature_changes]))
+            key_sharps2midoname = ['C',
+                'G', 'D', 'A', 'E', 'B', 'F#', 'C#m', 'G#m', 'D#m', 'Bbm', 'Fm',
+                'Gm', 'Dm', 'Am', 'Em', 'Bm', 'F#m', 'Db', 'Ab', 'Eb', 'Bb', 'F',
+            ]
+            key_num2midoname = [
+                'C', 'Db', 'D', 'Eb', 'E', 'F', 'F#', 'G', 'Ab', 'A', 'Bb', 'B',
+                'Cm', 'C#m', 'Dm', 'D#m', 'Em', 'Fm', 'F#m', 'Gm', 'G#m', 'Am',
+                'Bbm', 'Bm'
+            ]
+            def key_num2sharps(key_number):
+                s = key_sharps2midoname.index(key_num2midoname[key_number])
+                if s > 11:
+                    s -= len(key_sharps2midoname)
+                return s
+            time2keysig_change = defaultdict(str, dict([(ks.time, str(key_num2sharps(ks.key_number))) for ks in midi_data.key_signature_changes]))
+
+            labels = []
+            for beat in beats:
+                beat_label = 'b' if beat not in downbeats_set else 'db'
+                time_label = time2timesig_change[beat]
+                key_label = time2keysig_change[beat]
+                if key_label:
+                    label = ','.join([beat_label, time_label, key_label])
+                elif time_label:
+                    label = ','.join([beat_label, time_label])
+                else:
+                    label = beat_label
+                labels.append(label)
+            
+            write_annotation(performance_beat_annotation_internal, parse_labels(beats, labels))
+
 def get_beat_annotations(metadata, subset, args):
     print('\nGet beat annotations...', subset)
 
-    for i, row in metadata.iterrows():
-        print(i+1, '/', len(metadata), end='\r')
-
-        performance_beat_annotation_internal = os.path.join(load_path(row['folder']), row['performance_beat_annotation'])
-        score_beat_annotation_internal = os.path.join(load_path(row['folder']), row['score_beat_annotation'])
-
-        if not os.path.exists(performance_beat_annotation_internal) or not os.path.exists(score_beat_annotation_internal):
-
-            if row['source'] == 'ASAP':  # copy annotation files
-                performance_beat_annotation_external = load_path(row['performance_beat_annotation_external']).format(ASAP=args.ASAP)
-                score_beat_annotation_external = load_path(row['score_beat_annotation_external']).format(ASAP=args.ASAP)
-
-                performance_beat_annotation = pd.read_csv(performance_beat_annotation_external, sep='\t', header=None)[[1, 2]]
-                score_beat_annotation = pd.read_csv(score_beat_annotation_external, sep='\t', header=None)[[1, 2]]
-
-                performance_beat_annotation.to_csv(performance_beat_annotation_internal, sep='\t', header=None, index=False)
-                score_beat_annotation.to_csv(score_beat_annotation_internal, sep='\t', header=None, index=False)
-
-            else:  # generate annotation files (performance MIDI and MIDI score are the same)
-                MIDI_file = os.path.join(load_path(row['folder']), row['performance_MIDI'])
-                midi_data = pm.PrettyMIDI(MIDI_file)
-
-                beats = midi_data.get_beats()
-                downbeats_set = set(midi_data.get_downbeats())
-                time2timesig_change = defaultdict(str, dict([(ts.time, f'{ts.numerator}/{ts.denominator}') for ts in midi_data.time_signature_changes]))
-                key_sharps2midoname = ['C',
-                    'G', 'D', 'A', 'E', 'B', 'F#', 'C#m', 'G#m', 'D#m', 'Bbm', 'Fm',
-                    'Gm', 'Dm', 'Am', 'Em', 'Bm', 'F#m', 'Db', 'Ab', 'Eb', 'Bb', 'F',
-                ]
-                key_num2midoname = [
-                    'C', 'Db', 'D', 'Eb', 'E', 'F', 'F#', 'G', 'Ab', 'A', 'Bb', 'B',
-                    'Cm', 'C#m', 'Dm', 'D#m', 'Em', 'Fm', 'F#m', 'Gm', 'G#m', 'Am',
-                    'Bbm', 'Bm'
-                ]
-                def key_num2sharps(key_number):
-                    s = key_sharps2midoname.index(key_num2midoname[key_number])
-                    if s > 11:
-                        s -= len(key_sharps2midoname)
-                    return s
-                time2keysig_change = defaultdict(str, dict([(ks.time, str(key_num2sharps(ks.key_number))) for ks in midi_data.key_signature_changes]))
-
-                labels = []
-                for beat in beats:
-                    beat_label = 'b' if beat not in downbeats_set else 'db'
-                    time_label = time2timesig_change[beat]
-                    key_label = time2keysig_change[beat]
-                    if key_label:
-                        label = ','.join([beat_label, time_label, key_label])
-                    elif time_label:
-                        label = ','.join([beat_label, time_label])
-                    else:
-                        label = beat_label
-                    labels.append(label)
-                
-                annotation_df = pd.DataFrame({1: list(beats), 2: labels})
-                annotation_df.to_csv(performance_beat_annotation_internal, sep='\t', header=None, index=False)
-
-    print()
+    metadata_map(functools.partial(get_beat_annotation, args=args), metadata, workers=args.workers, chunksize=args.chunksize)
 
 def copy_audio_files(metadata, subset, args):
     print('\nCopy audio files from external sources...', subset)
 
+    pairs = []
     for i, row in metadata.iterrows():
-        print(i+1, '/', len(metadata), end='\r')
-
         if type(row['performance_audio_external']) == str:
             performance_audio_external = load_path(row['performance_audio_external']).format(MAPS=args.MAPS, ASAP=args.ASAP)
             folder = os.path.join('audio_files', load_path(row['folder']))
             performance_audio_internal = os.path.join(folder, row['performance_audio'])
+            pairs.append((performance_audio_external, performance_audio_internal))
+
+    materialize_files(pairs, mode=args.audio_mode, verify=args.verify, workers=args.io_workers)
+
+def get_beat_ticks_new(beat_ticks, resolution):
+    # new tick of every beat: one beat per resolution ticks, the part before the first beat scaled like
+    # the first beat (beats at the same tick stay at the same new tick)
+    beat_ticks = np.asarray(beat_ticks)
+    first_beat = resolution * beat_ticks[1] / (beat_ticks[2] - beat_ticks[1])
+    steps = np.where(beat_ticks[2:] > beat_ticks[1:-1], resolution, 0.)
+    return np.r_[0., np.cumsum(np.r_[first_beat, steps])]  # accumulated in order, no pairwise summation
 
-            mkdir(folder)
-            if not os.path.exists(performance_audio_internal):
-                subprocess.check_output(['cp', performance_audio_external, performance_audio_internal])
-                time.sleep(0.02)
-    print()
+def tick2new(ticks, beat_ticks, beat_ticks_new):
+    # piecewise-linear tick mapping between beats, truncated to int
+    return np.interp(ticks, beat_ticks, beat_ticks_new).astype(np.int64)
+
+def write_midi_with_tickmap(midi, beat_ticks, beat_ticks_new, score_beat_annotations, filename='test.mid'):
+    resolution = int(midi['resolution'])
+    warp = functools.partial(tick2new, beat_ticks=beat_ticks, beat_ticks_new=beat_ticks_new)
+    
+    # track 0 with timing information
+    timing_events = []
+    # add time signatures & key signatures
+    time_signatures = score_beat_annotations['time_signatures']
+    time_signature_ticks = warp(time_to_tick(midi, time_signatures['time'])).tolist()
+    for ts, tick in zip(time_signatures.tolist(), time_signature_ticks):
+        timing_events.append(meta_event(tick, 'time_signature', numerator=ts[2], denominator=ts[3]))
+    key_sharps2name = ['C',
+        'G', 'D', 'A', 'E', 'B', 'F#', 'C#m', 'G#m', 'D#m', 'Bbm', 'Fm',
+        'Gm', 'Dm', 'Am', 'Em', 'Bm', 'F#m', 'Db', 'Ab', 'Eb', 'Bb', 'F',
+    ]
+    key_signatures = score_beat_annotations['key_signatures']
+    key_signature_ticks = warp(time_to_tick(midi, key_signatures['time'])).tolist()
+    for ks, tick in zip(key_signatures.tolist(), key_signature_ticks):
+        timing_events.append(meta_event(tick, 'key_signature', key=key_sharps2name[ks[2]]))
+    # add tempo changes
+    beat_times = tick_to_time(midi, beat_ticks)
+    for beat_index in range(len(beat_ticks)-1):
+        gap_in_second = beat_times[beat_index+1] - beat_times[beat_index]
+        gap_in_ticknew = beat_ticks_new[beat_index+1] - beat_ticks_new[beat_index]
+        tempo = gap_in_second * 1e6 / (gap_in_ticknew / resolution)
+        timing_events.append(meta_event(int(beat_ticks_new[beat_index]), 'set_tempo', tempo=int(tempo)))
+    tracks = [encode_track(meta_events=timing_events)]
+
+    # add tracks
+    channels = list(range(16))
+    channels.remove(9)
+    for ii, instrument in enumerate(midi['instruments'].tolist()):
+        channel = channels[ii % len(channels)]
+        notes = midi['notes'][midi['notes']['instrument'] == ii]
+        control_changes = midi['control_changes'][midi['control_changes']['instrument'] == ii]
+        events = np.concatenate([
+            program_change_events([0], [instrument[0]], channel),  # set the program number
+            note_events(warp(time_to_tick(midi, notes['start'])),
+                        warp(time_to_tick(midi, notes['end'])),
+                        notes['pitch'],
+                        notes['velocity'],
+                        channel,
+                        note_off_first=True),
+            control_change_events(warp(time_to_tick(midi, control_changes['time'])),
+                                control_changes['number'],
+                                control_changes['value'],
+                                channel),
+        ])
+        tracks.append(encode_track(events))
+
+    write_midi(filename, tracks, resolution)
+
+def update_ASAP_score_annotation(row, args):
+    # udpate annotations in MIDI_score
+    MIDI_score_file_external = load_path(row['MIDI_score_external']).format(ASAP=args.ASAP)
+    score_beat_annotation_file = load_path(row['score_beat_annotation_external']).format(ASAP=args.ASAP)
+
+    midi = load_midi(MIDI_score_file_external)
+    score_beat_annotations = read_annotation(score_beat_annotation_file, time_column=0, label_column=2)
+
+    # get ticks for beats in original MIDI_score
+    beat_ticks = time_to_tick(midi, score_beat_annotations['times']).tolist()
+    # add 0. for start, although tick 0 may not be a beat
+    if beat_ticks[0] != 0.:
+        beat_ticks = [0] + beat_ticks
+    # fill up missing beats in the beginning
+    if beat_ticks[1] / (beat_ticks[2] - beat_ticks[1]) > 1.5:
+        ticks_insert = []
+        gap = beat_ticks[2] - beat_ticks[1]
+        tick_insert = beat_ticks[1] - gap
+        while tick_insert > gap * 0.2:
+            ticks_insert = [tick_insert] + ticks_insert
+            tick_insert -= gap
+        beat_ticks = [beat_ticks[0]] + ticks_insert + beat_ticks[1:]
+    # add missing beats in the end
+    max_tick = int(time_to_tick(midi, midi['end_time']))
+    gap = beat_ticks[-1] - beat_ticks[-2]
+    while beat_ticks[-1] < max_tick:
+        beat_ticks.append(beat_ticks[-1] + gap)
+
+    # get tick to new tick mapping
+    beat_ticks_new = get_beat_ticks_new(beat_ticks, int(midi['resolution']))
+    
+    # write midi events to MIDI object
+    MIDI_score_file = os.path.join(load_path(row['folder']), row['MIDI_score'])
+    write_midi_with_tickmap(midi, beat_ticks, beat_ticks_new, score_beat_annotations, filename=MIDI_score_file)
 
 def update_ASAP_score_annotations(metadata, subset, args):
     print('\nUpdate ASAP score annotations...', subset)
 
-    def write_midi_with_tickmap(midi_data, tick2new, score_beat_annotations, beat_ticks, filename='test.mid'):
-        
-        def event_compare(event1, event2):
-            secondary_sort = {
-                'set_tempo': lambda e: (1 * 256 * 256),
-                'time_signature': lambda e: (2 * 256 * 256),
-                'key_signature': lambda e: (3 * 256 * 256),
-                'lyrics': lambda e: (4 * 256 * 256),
-                'text_events' :lambda e: (5 * 256 * 256),
-                'program_change': lambda e: (6 * 256 * 256),
-                'pitchwheel': lambda e: ((7 * 256 * 256) + e.pitch),
-                'control_change': lambda e: (
-                    (8 * 256 * 256) + (e.control * 256) + e.value),
-                'note_off': lambda e: ((9 * 256 * 256) + (e.note * 256)),
-                'note_on': lambda e: (
-                    (10 * 256 * 256) + (e.note * 256) + e.velocity) if e.velocity > 0 
-                    else ((9 * 256 * 256) + (e.note * 256)),
-                'end_of_track': lambda e: (11 * 256 * 256)
-            }
-            if event1.time == event2.time and event1.type in secondary_sort and event2.type in secondary_sort:
-                return secondary_sort[event1.type](event1) - secondary_sort[event2.type](event2)
-            return event1.time - event2.time
-
-        mid = mido.MidiFile(ticks_per_beat=midi_data.resolution)
-        
-        # track 0 with timing information
-        timing_track = mido.MidiTrack()
-        # add time signatures & key signatures
-        time_signature_changes = [(row[0], row[2].split(',')[1]) for i, row in score_beat_annotations.iterrows() if len(row[2].split(',')) > 1 and row[2].split(',')[1] != '']
-        for ts in time_signature_changes:
-            timing_track.append(mido.MetaMessage('time_signature',
-                                                time=int(tick2new[midi_data.time_to_tick(ts[0])]),
-                                                numerator=int(ts[1].split('/')[0]),
-                                                denominator=int(ts[1].split('/')[1])))
-        key_sharps2name = ['C',
-            'G', 'D', 'A', 'E', 'B', 'F#', 'C#m', 'G#m', 'D#m', 'Bbm', 'Fm',
-            'Gm', 'Dm', 'Am', 'Em', 'Bm', 'F#m', 'Db', 'Ab', 'Eb', 'Bb', 'F',
-        ]
-        key_signature_changes = [(row[0], row[2].split(',')[2]) for i, row in score_beat_annotations.iterrows() if len(row[2].split(',')) == 3]
-        for ks in key_signature_changes:
-            timing_track.append(mido.MetaMessage('key_signature',
-                                                time=int(tick2new[midi_data.time_to_tick(ks[0])]),
-                                                key=key_sharps2name[int(ks[1])]))
-        # add tempo changes
-        for beat_index in range(len(beat_ticks)-1):
-            gap_in_second = midi_data.tick_to_time(beat_ticks[beat_index+1]) - midi_data.tick_to_time(beat_ticks[beat_index])
-            gap_in_ticknew = tick2new[beat_ticks[beat_index+1]] - tick2new[beat_ticks[beat_index]]
-            tempo = gap_in_second * 1e6 / (gap_in_ticknew / midi_data.resolution)
-            timing_track.append(mido.MetaMessage('set_tempo', 
-                                                time=int(tick2new[beat_ticks[beat_index]]),
-                                                tempo=int(tempo)))
-        # sort events
-        timing_track.sort(key=functools.cmp_to_key(event_compare))
-        # add end of track event
-        timing_track.append(mido.MetaMessage('end_of_track', time=timing_track[-1].time+1))
-        # add track
-        mid.tracks.append(timing_track)
-
-        # add tracks
-        channels = list(range(16))
-        channels.remove(9)
-        for ii, instrument in enumerate(midi_data.instruments):
-            track = mido.MidiTrack()
-            channel = channels[ii % len(channels)]
-            # set the program number
-            track.append(mido.Message('program_change', 
-                                        time=0, 
-                                        program=instrument.program,
-                                        channel=channel))
-            # add note events
-            for note in instrument.notes:
-                track.append(mido.Message('note_on', 
-                                        time=int(tick2new[midi_data.time_to_tick(note.start)]),
-                                        channel=channel,
-                                        note=note.pitch,
-                                        velocity=note.velocity))
-                track.append(mido.Message('note_on',
-                                        time=int(tick2new[midi_data.time_to_tick(note.end)]),
-                                        channel=channel,
-                                        note=note.pitch,
-                                        velocity=0))
-            # add control change events
-            for cc in instrument.control_changes:
-                track.append(mido.Message('control_change',
-                                        time=int(tick2new[midi_data.time_to_tick(cc.time)]),
-                                        channel=channel,
-                                        control=cc.number,
-                                        value=cc.value))
-            # sort all the events
-            track = sorted(track, key=functools.cmp_to_key(event_compare))
-            # add end of track event
-            track.append(mido.MetaMessage('end_of_track', time=track[-1].time+1))
-            # add track
-            mid.tracks.append(track)
-
-        # ticks from absolute to relative
-        for track in mid.tracks:
-            tick = 0
-            for event in track:
-                event.time -= tick
-                tick += event.time
-
-        mid.save(filename=filename)
-
-    updated = set()
-
-    for i, row in metadata.iterrows():
-        print(i+1, '/', len(metadata), end='\r')
-
-        if row['source'] == 'ASAP':
-            if row['MIDI_score_external'] not in updated:
-                # keep track of updated ones
-                updated.add(row['MIDI_score_external'])
-
-                # udpate annotations in MIDI_score
-                MIDI_score_file = load_path(row['MIDI_score_external']).format(ASAP=args.ASAP)
-                score_beat_annotation_file = load_path(row['score_beat_annotation_external']).format(ASAP=args.ASAP)
-
-                midi_data = pm.PrettyMIDI(MIDI_score_file)
-                score_beat_annotations = pd.read_csv(score_beat_annotation_file, header=None, sep='\t')
-
-                # get ticks for beats in original MIDI_score
-                beat_ticks = [midi_data.time_to_tick(beat) for beat in score_beat_annotations[0]]
-                # add 0. for start, although tick 0 may not be a beat
-                if beat_ticks[0] != 0.:
-                    beat_ticks = [0] + beat_ticks
-                # fill up missing beats in the beginning
-                if beat_ticks[1] / (beat_ticks[2] - beat_ticks[1]) > 1.5:
-                    ticks_insert = []
-                    gap = beat_ticks[2] - beat_ticks[1]
-                    tick_insert = beat_ticks[1] - gap
-                    while tick_insert > gap * 0.2:
-                        ticks_insert = [tick_insert] + ticks_insert
-                        tick_insert -= gap
-                    beat_ticks = [beat_ticks[0]] + ticks_insert + beat_ticks[1:]
-                # add missing beats in the end
-                max_tick = midi_data.time_to_tick(midi_data.get_end_time())
-                gap = beat_ticks[-1] - beat_ticks[-2]
-                while beat_ticks[-1] < max_tick:
-                    beat_ticks.append(beat_ticks[-1] + gap)
-
-                # get tick to new tick mapping
-                tick2new = np.zeros(beat_ticks[-1]+1)  # float for now, round to int later
-                tick2new[:beat_ticks[1]+1] = np.linspace(start=0, 
-                                                        stop=midi_data.resolution * beat_ticks[1] / (beat_ticks[2] - beat_ticks[1]), 
-                                                        num=beat_ticks[1]+1)
-                for beat_index in range(1, len(beat_ticks)-1):
-                    tick2new[beat_ticks[beat_index]:beat_ticks[beat_index+1]+1] = np.linspace(start=tick2new[beat_ticks[beat_index]], 
-                                                        stop=tick2new[beat_ticks[beat_index]]+midi_data.resolution, 
-                                                        num=beat_ticks[beat_index+1]-beat_ticks[beat_index]+1)
-                
-                # write midi events to MIDI object
-                MIDI_score_file = os.path.join(load_path(row['folder']), row['MIDI_score'])
-                write_midi_with_tickmap(midi_data, tick2new, score_beat_annotations, beat_ticks, filename=MIDI_score_file)
+    # MIDI scores are shared between performances, update each of them once
+    metadata_ASAP = metadata.loc[metadata['source'] == 'ASAP'].drop_duplicates('MIDI_score_external')
+    metadata_map(functools.partial(update_ASAP_score_annotation, args=args), metadata_ASAP, workers=args.workers, chunksize=args.chunksize)
+
+## build stages: dependencies, and the outputs and inputs of every performance
+## (list of (output, inputs, is_file)) recorded in the build manifest
+stage_dependencies = {
+    'metadata': [],
+    'midi': ['metadata'],
+    'durations': ['midi'],
+    'annotations': ['midi'],
+    'audio': ['metadata'],
+    'score_annotations': ['midi', 'annotations'],
+    'pianorolls': ['midi', 'score_annotations'],
+}
+
+def midi_targets(row, args):
+    folder = load_path(row['folder'])
+    performance_MIDI_external = load_path(row['performance_MIDI_external']).format(A_MAPS=args.A_MAPS, CPM=args.CPM, ASAP=args.ASAP)
+    MIDI_score_external = load_path(row['MIDI_score_external']).format(A_MAPS=args.A_MAPS, CPM=args.CPM, ASAP=args.ASAP)
+    targets = [(os.path.join(folder, row['performance_MIDI']), [performance_MIDI_external], True)]
+    if row['source'] != 'ASAP':  # ASAP MIDI scores are rewritten by the score_annotations stage
+        targets.append((os.path.join(folder, row['MIDI_score']), [MIDI_score_external], True))
+    return targets
+
+def durations_targets(row, args):
+    performance_MIDI_internal = os.path.join(load_path(row['folder']), row['performance_MIDI'])
+    return [(row['performance_id'] + ':duration', [performance_MIDI_internal], False)]
+
+def annotations_targets(row, args):
+    folder = load_path(row['folder'])
+    performance_beat_annotation_internal = os.path.join(folder, row['performance_beat_annotation'])
+    score_beat_annotation_internal = os.path.join(folder, row['score_beat_annotation'])
+    if row['source'] == 'ASAP':
+        performance_beat_annotation_external = load_path(row['performance_beat_annotation_external']).format(ASAP=args.ASAP)
+        score_beat_annotation_external = load_path(row['score_beat_annotation_external']).format(ASAP=args.ASAP)
+        return [(performance_beat_annotation_internal, [performance_beat_annotation_external], True),
+                (score_beat_annotation_internal, [score_beat_annotation_external], True)]
+    performance_MIDI_internal = os.path.join(folder, row['performance_MIDI'])
+    return [(performance_beat_annotation_internal, [performance_MIDI_internal], True)]
+
+def audio_targets(row, args):
+    if type(row['performance_audio_external']) != str:
+        return []  # synthesized, see synthesis.py
+    performance_audio_external = load_path(row['performance_audio_external']).format(MAPS=args.MAPS, ASAP=args.ASAP)
+    performance_audio_internal = os.path.join('audio_files', load_path(row['folder']), row['performance_audio'])
+    return [(performance_audio_internal, [performance_audio_external], True)]
+
+def score_annotations_targets(row, args):
+    if row['source'] != 'ASAP':
+        return []
+    MIDI_score_external = load_path(row['MIDI_score_external']).format(ASAP=args.ASAP)
+    score_beat_annotation_external = load_path(row['score_beat_annotation_external']).format(ASAP=args.ASAP)
+    MIDI_score_internal = os.path.join(load_path(row['folder']), row['MIDI_score'])
+    return [(MIDI_score_internal, [MIDI_score_external, score_beat_annotation_external], True)]
+
+def pianorolls_targets(row, args):
+    folder = load_path(row['folder'])
+    MIDI_files = [os.path.join(folder, row['performance_MIDI']), os.path.join(folder, row['MIDI_score'])]
+    return [(row['performance_id'] + ':pianorolls', MIDI_files, False)]
+
+stage_targets = {
+    'midi': midi_targets,
+    'durations': durations_targets,
+    'annotations': annotations_targets,
+    'audio': audio_targets,
+    'score_annotations': score_annotations_targets,
+    'pianorolls': pianorolls_targets,
+}
+## outputs that are not files (metadata values, cache entries) are also rebuilt when the
+## value itself is missing, e.g. durations of a metadata stage run in the same invocation
+def durations_missing(row, args):
+    return pd.isna(row['duration'])
+
+def pianorolls_missing(row, args):
+    folder = load_path(row['folder'])
+    for column in ['performance_MIDI', 'MIDI_score']:
+        midi_file = os.path.join(folder, row[column])
+        if not os.path.exists(midi_file):
+            return True
+        for fs in args.pianoroll_fs:
+            for pedal_threshold in PIANOROLL_PEDAL_THRESHOLDS:
+                if not os.path.exists(store_file(midi_file, fs, pedal_threshold)):
+                    return True
+    return False
+
+stage_values_missing = {
+    'durations': durations_missing,
+    'pianorolls': pianorolls_missing,
+}
+stage_versions = {
+    'midi': (1, [copy_midi_files]),
+    'durations': (2, [update_performance_durations, get_performance_duration, scan_midi]),
+    'annotations': (1, [get_beat_annotations, get_beat_annotation]),
+    'audio': (1, [copy_audio_files]),
+    'score_annotations': (1, [update_ASAP_score_annotations, update_ASAP_score_annotation, write_midi_with_tickmap, encode_track, note_events]),
+    'pianorolls': (1, [build_pianoroll_store, store_row_pianorolls, compute_pianoroll, merge_intervals, apply_pedal]),
+}
+
+def create_metadata(args):
+    CPM_metadata_dict = get_CPM_metadata_dict(args)
+    distinct_pieces_dict = get_distinct_pieces_dict(args)  # original distinct pieces are manually checked
+
+    distinct_pieces_dict, metadata_R =  create_real_recording_subset(distinct_pieces_dict, 
+                                                                    CPM_metadata_dict, 
+                                                                    args)
+    distinct_pieces_dict, metadata_S = create_synthetic_subset(distinct_pieces_dict, 
+                                                                CPM_metadata_dict, 
+                                                                args)
+    update_distinct_pieces(distinct_pieces_dict)
+    return metadata_R, metadata_S
+
+def run_stage(stage, metadata, subset, args, manifest):
+    # run a stage on the performances whose outputs are missing or out of date
+    targets = functools.partial(stage_targets[stage], args=args)
+    version = stage_version(*stage_versions[stage])
+    stale = stale_rows(manifest, metadata, targets, stage, version)
+    if stage in stage_values_missing:
+        missing = functools.partial(stage_values_missing[stage], args=args)
+        stale = [row_stale or missing(row) for row_stale, row in zip(stale, metadata.to_dict('records'))]
+    metadata_stale = metadata.loc[stale]
+    print('\n{}: {} / {} performances to update ({})'.format(stage, len(metadata_stale), len(metadata), subset))
+    if len(metadata_stale) == 0:
+        return metadata
+
+    # remove out-of-date outputs, so the stage rebuilds them
+    for row in metadata_stale.to_dict('records'):
+        for output, inputs, is_file in targets(row):
+            if is_file and os.path.exists(output):
+                os.remove(output)
+
+    if stage == 'midi':
+        copy_midi_files(metadata_stale, subset, args)
+    elif stage == 'durations':
+        metadata_stale = update_performance_durations(metadata_stale.copy(), subset, args)
+        metadata.loc[stale, 'duration'] = metadata_stale['duration']
+    elif stage == 'annotations':
+        get_beat_annotations(metadata_stale, subset, args)
+    elif stage == 'audio':
+        copy_audio_files(metadata_stale, subset, args)
+    elif stage == 'score_annotations':
+        update_ASAP_score_annotations(metadata_stale, subset, args)
+    elif stage == 'pianorolls':
+        build_pianoroll_store(metadata_stale, subset, fs_list=args.pianoroll_fs, workers=args.workers, chunksize=args.chunksize)
+
+    # only reached if the stage succeeded: a failing stage raises (materialize_files errors included),
+    # so its rows are not recorded and are rebuilt on the next run
+    record_rows(manifest, metadata_stale, targets, stage, version)
+    return metadata
 
 if __name__ == '__main__':
 
@@ -792,44 +878,60 @@ if __name__ == '__main__':
                         # default='C:\\Users\\Marco\\Downloads\\Datasets\\maestro-v2.0.0',
                         default='/import/c4dm-datasets/maestro-v2.0.0',
                         help='Path to the MAESTRO-v2.0.0 dataset')
+    parser.add_argument('--workers',
+                        type=int,
+                        default=None,
+                        help='Number of worker processes for the per-performance loops (default: all cores)')
+    parser.add_argument('--chunksize',
+                        type=int,
+                        default=8,
+                        help='Number of performances sent to a worker process at a time')
+    parser.add_argument('--audio_mode',
+                        type=str,
+                        choices=[mode for mode in materialize_modes if mode != 'move'],  # never move external files
+                        default='copy',
+                        help='How audio files are put into audio_files/ (hardlink/reflink/symlink avoid full copies)')
+    parser.add_argument('--verify',
+                        type=str,
+                        choices=verify_modes,
+                        default='size',
+                        help='Check copied files by size or checksum')
+    parser.add_argument('--io_workers',
+                        type=int,
+                        default=16,
+                        help='Number of concurrent file copies')
+    parser.add_argument('--pianoroll_fs',
+                        type=int,
+                        nargs='+',
+                        default=[100],
+                        help='Frame rates of the stored piano rolls (pianorolls stage)')
+    parser.add_argument('--stages',
+                        type=str,
+                        nargs='+',
+                        choices=list(stage_dependencies.keys()),
+                        default=['midi', 'durations', 'annotations', 'audio', 'score_annotations', 'pianorolls'],
+                        help='Build stages to run, in dependency order. Only performances with missing or out-of-date outputs are rebuilt')
     args = parser.parse_args()
 
-    # CPM_metadata_dict = get_CPM_metadata_dict(args)
-    # distinct_pieces_dict = get_distinct_pieces_dict(args)  # original distinct pieces are manually checked
-
-    # distinct_pieces_dict, metadata_R =  create_real_recording_subset(distinct_pieces_dict, 
-    #                                                                 CPM_metadata_dict, 
-    #                                                                 args)
-    # distinct_pieces_dict, metadata_S = create_synthetic_subset(distinct_pieces_dict, 
-    #                                                             CPM_metadata_dict, 
-    #                                                             args)
-    # update_distinct_pieces(distinct_pieces_dict)
-
-    # ## get performance MIDIs and MIDI scores
-    # copy_midi_files(metadata_R, 'Real recording subset', args)
-    # copy_midi_files(metadata_S, 'Synthetic subset', args)
-
-    # ## get durations and update metadata
-    # metadata_R = update_performance_durations(metadata_R, 'Real recoding subset')
-    # metadata_S = update_performance_durations(metadata_S, 'Synthetic subset')
-
-    # ## save metadata
-    # metadata_R.to_csv('metadata_R.csv', index=False)
-    # metadata_S.to_csv('metadata_S.csv', index=False)
-
-    # ## get beat annotations
-    # get_beat_annotations(metadata_R, 'Real recording subset', args)
-    # get_beat_annotations(metadata_S, 'Synthetic subset', args)
-
-    # ## get performance audios
-    metadata_R = pd.read_csv('metadata_R.csv')
-    metadata_S = pd.read_csv('metadata_S.csv')
-    copy_audio_files(metadata_R, 'Real recording subset', args)
-    copy_audio_files(metadata_S, 'Synthetic subset', args)
-    # # TODO: synthesize Kontakt audio files in reaper
-
-    # ## update beat annotations in MIDI_score files
-    # update_ASAP_score_annotations(metadata_R, 'Real recording subset', args)
-    # update_ASAP_score_annotations(metadata_S, 'Synthetic subset', args)
-
-
+    manifest = load_manifest()
+    if 'metadata' in args.stages:
+        metadata_R, metadata_S = create_metadata(args)
+    else:
+        metadata_R = pd.read_csv('metadata_R.csv')
+        metadata_S = pd.read_csv('metadata_S.csv')
+
+    # audio of the synthetic subset is rendered separately with synthesis.py, after the audio stage
+    for stage in stage_order(args.stages, stage_dependencies):
+        if stage != 'metadata':
+            metadata_R = run_stage(stage, metadata_R, 'Real recording subset', args, manifest)
+            metadata_S = run_stage(stage, metadata_S, 'Synthetic subset', args, manifest)
+            save_manifest(manifest)
+
+        ## save metadata
+        if stage in ['metadata', 'durations']:
+            metadata_R.to_csv('metadata_R.csv', index=False)
+            metadata_S.to_csv('metadata_S.csv', index=False)
+            try:
+                write_metadata_store()
+            except ImportError:
+                print('pyarrow not installed, Parquet metadata not written')
@@ -0,0 +1,135 @@
+import collections
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from acpas_index import ACPASIndex
+from audio_io import load_wav_mmap
+from midi_cache import load_midi
+from annotation_codec import read_annotation
+
+## Streaming loader of aligned (audio window, performance notes, score notes)
+## examples, numpy only. Audio is memory-mapped, so a window is a view on the
+## file and nothing outside it is read. Score notes are mapped to performance
+## time through the beat annotations.
+##
+##   for example in iterate_windows('train', window_seconds=10.):
+##       example['audio'], example['performance_notes'], example['score_notes']
+
+def read_beats(annotation_file):
+    return read_annotation(annotation_file)['times']
+
+def warp_times(times, beats_from, beats_to):
+    # piecewise-linear map between two beat sequences, linear extrapolation past both ends
+    warped = np.interp(times, beats_from, beats_to)
+    if len(beats_from) > 1:
+        before = times < beats_from[0]
+        after = times > beats_from[-1]
+        slope_first = (beats_to[1] - beats_to[0]) / (beats_from[1] - beats_from[0])
+        slope_last = (beats_to[-1] - beats_to[-2]) / (beats_from[-1] - beats_from[-2])
+        warped[before] = beats_to[0] + (times[before] - beats_from[0]) * slope_first
+        warped[after] = beats_to[-1] + (times[after] - beats_from[-1]) * slope_last
+    return warped
+
+def notes_in_window(notes, max_ends, start, end):
+    # notes sounding in [start, end), notes sorted by start and max_ends the running maximum of their ends
+    lo = np.searchsorted(max_ends, start, side='right')
+    hi = np.searchsorted(notes['start'], end, side='left')
+    window = notes[lo:hi]
+    window = window[window['end'] > start].copy()
+    window['start'] -= start
+    window['end'] -= start
+    return window
+
+def sort_notes(notes):
+    notes = np.sort(notes, order=['start', 'pitch'])
+    return notes, np.maximum.accumulate(notes['end']) if len(notes) else notes['end']
+
+def score_notes_in_performance_time(index, row):
+    # score notes with onsets/offsets mapped to performance time, None if not aligned
+    if not row['aligned']:
+        return None
+    paths = index.paths(row)
+    performance_beats = read_beats(paths.get('performance_beat_annotation', paths.get('performance_annotation')))
+    score_beats = read_beats(paths.get('score_beat_annotation', paths.get('score_annotation')))
+    if len(performance_beats) != len(score_beats) or len(score_beats) < 2:
+        return None
+
+    notes = load_midi(paths['MIDI_score'])['notes'].copy()
+    notes['start'] = warp_times(notes['start'], score_beats, performance_beats)
+    notes['end'] = warp_times(notes['end'], score_beats, performance_beats)
+    return notes
+
+def performance_windows(index, row, window_seconds, hop_seconds):
+    # all examples of one performance
+    paths = index.paths(row)
+    audio, sample_rate = load_wav_mmap(paths['performance_audio'])
+    performance_notes, performance_max_ends = sort_notes(load_midi(paths['performance_MIDI'])['notes'])
+    score_notes = score_notes_in_performance_time(index, row)
+    if score_notes is not None:
+        score_notes, score_max_ends = sort_notes(score_notes)
+
+    window_samples = int(round(window_seconds * sample_rate))
+    duration = len(audio) / sample_rate
+    examples = []
+    for start in np.arange(0., max(duration - window_seconds, 0.) + 1e-9, hop_seconds):
+        start_sample = int(round(start * sample_rate))
+        end = start + window_seconds
+        examples.append({
+            'performance_id': row['performance_id'],
+            'start': start,
+            'end': end,
+            'sample_rate': sample_rate,
+            'audio': audio[start_sample:start_sample+window_samples],  # view on the memory-mapped file
+            'performance_notes': notes_in_window(performance_notes, performance_max_ends, start, end),
+            'score_notes': None if score_notes is None else notes_in_window(score_notes, score_max_ends, start, end),
+        })
+    return examples
+
+def iterate_windows(split,
+                    window_seconds=10.,
+                    hop_seconds=None,
+                    shuffle=True,
+                    buffer_size=512,
+                    workers=4,
+                    prefetch=8,
+                    seed=None,
+                    index=None,
+                    **conditions):
+    # yield examples of the performances in a split, extra conditions go to ACPASIndex.select
+    # (e.g. source='ASAP'). Performances are prepared on a thread pool, up to prefetch ahead,
+    # and examples are shuffled through a buffer of buffer_size examples.
+    index = ACPASIndex() if index is None else index
+    hop_seconds = window_seconds if hop_seconds is None else hop_seconds
+    rng = np.random.default_rng(seed)
+
+    rows = list(index.select(split=split, **conditions))
+    if shuffle:
+        rows = [rows[i] for i in rng.permutation(len(rows))]
+
+    buffer = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = collections.deque()
+        rows_iter = iter(rows)
+        for row in rows_iter:
+            pending.append(executor.submit(performance_windows, index, row, window_seconds, hop_seconds))
+            if len(pending) >= prefetch:
+                break
+        while pending:
+            examples = pending.popleft().result()
+            row = next(rows_iter, None)
+            if row is not None:
+                pending.append(executor.submit(performance_windows, index, row, window_seconds, hop_seconds))
+
+            for example in examples:
+                if not shuffle:
+                    yield example
+                    continue
+                buffer.append(example)
+                if len(buffer) >= buffer_size:
+                    i = rng.integers(len(buffer))
+                    buffer[i], buffer[-1] = buffer[-1], buffer[i]
+                    yield buffer.pop()
+
+    # drain the shuffle buffer
+    for i in rng.permutation(len(buffer)):
+        yield buffer[i]
@@ -0,0 +1,128 @@
+import os
+import sys
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+from utilities import file_hash, mkdir
+
+## Put external files into the dataset tree without forking a process per file.
+##   copy:     in-kernel copy (copy_file_range / sendfile), falls back to shutil
+##   hardlink: hard link, source and destination must be on the same filesystem
+##   reflink:  copy-on-write clone (btrfs, xfs, ...), falls back to copy
+##   symlink:  symbolic link to the absolute source path
+##   move:     rename, falls back to copy and remove across filesystems
+materialize_modes = ['copy', 'hardlink', 'reflink', 'symlink', 'move']
+verify_modes = ['none', 'size', 'checksum']
+FICLONE = 0x40049409  # linux ioctl to clone a file
+
+def copy_file(src, dst):
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        size = os.fstat(fsrc.fileno()).st_size
+        copied = 0
+        try:
+            if hasattr(os, 'copy_file_range'):
+                while copied < size:
+                    n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), size - copied)
+                    if n == 0:
+                        break
+                    copied += n
+            elif hasattr(os, 'sendfile') and sys.platform.startswith('linux'):
+                while copied < size:
+                    n = os.sendfile(fdst.fileno(), fsrc.fileno(), copied, size - copied)
+                    if n == 0:
+                        break
+                    copied += n
+        except OSError:
+            pass  # not supported between these filesystems, copy the rest in user space
+        if copied < size:
+            fsrc.seek(copied)
+            fdst.seek(copied)
+            shutil.copyfileobj(fsrc, fdst, 1 << 20)
+    shutil.copystat(src, dst)
+
+def reflink_file(src, dst):
+    try:
+        import fcntl
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        shutil.copystat(src, dst)
+    except (ImportError, OSError):
+        copy_file(src, dst)
+
+def move_file(src, dst):
+    try:
+        os.replace(src, dst)
+    except OSError:
+        copy_file(src, dst)
+        os.remove(src)
+
+def materialize_file(src, dst, mode='copy'):
+    mkdir(os.path.dirname(dst) or '.')
+    if mode == 'copy':
+        # write next to the destination first, so an interrupted copy never leaves a partial file behind
+        tmp = dst + '.part'
+        copy_file(src, tmp)
+        os.replace(tmp, dst)
+    elif mode == 'hardlink':
+        os.link(src, dst)
+    elif mode == 'reflink':
+        tmp = dst + '.part'
+        reflink_file(src, tmp)
+        os.replace(tmp, dst)
+    elif mode == 'symlink':
+        os.symlink(os.path.abspath(src), dst)
+    elif mode == 'move':
+        move_file(src, dst)
+    else:
+        raise ValueError('Unknown materialize mode: {}'.format(mode))
+
+def verify_file(src, dst, verify='size'):
+    # True if the destination matches the source
+    if verify == 'none':
+        return True
+    if not os.path.exists(dst) or os.path.getsize(src) != os.path.getsize(dst):
+        return False
+    if verify == 'checksum':
+        return file_hash(src) == file_hash(dst)
+    return True
+
+def materialize_pair(pair, mode, verify):
+    src, dst = pair
+    if os.path.lexists(dst):
+        return None  # already there
+    try:
+        # for moves the source is gone afterwards, check the size before
+        if mode == 'move' and verify != 'none':
+            size, checksum = os.path.getsize(src), file_hash(src) if verify == 'checksum' else None
+            materialize_file(src, dst, mode)
+            if os.path.getsize(dst) != size or (checksum is not None and file_hash(dst) != checksum):
+                return 'verification failed: {} -> {}'.format(src, dst)
+            return None
+        materialize_file(src, dst, mode)
+        if not verify_file(src, dst, verify):
+            if os.path.lexists(dst):
+                os.remove(dst)  # the source is still there, a later run materializes it again
+            return 'verification failed: {} -> {}'.format(src, dst)
+    except OSError as e:
+        return '{}: {} -> {}'.format(e, src, dst)
+    return None
+
+def materialize_files(pairs, mode='copy', verify='size', workers=16, verbose=True, strict=True):
+    # materialize (source, destination) pairs on a thread pool, existing destinations are skipped
+    # returns the list of errors, strict raises a RuntimeError if there is any
+    pairs = list(pairs)
+    errors = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(lambda pair: materialize_pair(pair, mode, verify), pairs)
+        for i, error in enumerate(results):
+            if verbose:
+                print(i+1, '/', len(pairs), end='\r')
+            if error is not None:
+                errors.append(error)
+    if verbose:
+        print()
+        for error in errors:
+            print('Error:', error)
+    if strict and errors:
+        raise RuntimeError('{} / {} files not materialized:\n{}'.format(len(errors), len(pairs), '\n'.join(errors)))
+    return errors
@@ -0,0 +1,83 @@
+import os
+import argparse
+import pandas as pd
+
+## Typed Parquet copies of the metadata CSVs. Categorical columns are
+## dictionary-encoded, and readers can load a subset of columns and filter on
+## split/source without parsing the whole CSV. pyarrow is optional: without it
+## (or without the .parquet files) the loader reads the CSVs instead.
+metadata_files = ['metadata_R.csv', 'metadata_S.csv', 'distinct_pieces.csv']
+categorical_columns = ['composer', 'source', 'split', 'folder']
+metadata_dtypes = {
+    'id': 'int32',
+    'piece_id': 'int32',
+    'aligned': 'bool',
+    'duration': 'float64',
+}
+
+def parquet_file(csv_file):
+    return os.path.splitext(csv_file)[0] + '.parquet'
+
+def typed_metadata(metadata):
+    # apply the schema: known dtypes, categoricals, every other column as string
+    metadata = metadata.copy()
+    for column in metadata.columns:
+        if column in metadata_dtypes:
+            metadata[column] = metadata[column].astype(metadata_dtypes[column])
+        elif column in categorical_columns:
+            metadata[column] = metadata[column].astype('category')
+        else:
+            metadata[column] = metadata[column].astype('string')
+    return metadata
+
+def write_metadata_store(csv_files=metadata_files):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    for csv_file in csv_files:
+        metadata = typed_metadata(pd.read_csv(csv_file))
+        table = pa.Table.from_pandas(metadata, preserve_index=False)
+        pq.write_table(table, parquet_file(csv_file))
+        print('Written', parquet_file(csv_file), table.num_rows, 'rows')
+
+def load_metadata(csv_file, columns=None, split=None, source=None):
+    # metadata with only the requested columns and rows from the requested split(s)/source(s)
+    split = [split] if isinstance(split, str) else split
+    source = [source] if isinstance(source, str) else source
+
+    filters = []
+    if split is not None:
+        filters.append(('split', 'in', list(split)))
+    if source is not None:
+        filters.append(('source', 'in', list(source)))
+
+    try:
+        import pyarrow.parquet as pq
+        use_parquet = os.path.exists(parquet_file(csv_file)) and os.path.getmtime(parquet_file(csv_file)) >= os.path.getmtime(csv_file)
+    except ImportError:
+        use_parquet = False
+
+    if use_parquet:
+        table = pq.read_table(parquet_file(csv_file), columns=columns, filters=filters or None)
+        return table.to_pandas()
+
+    # fall back to the CSV
+    usecols = None if columns is None else list(set(columns) | set(f[0] for f in filters))
+    metadata = typed_metadata(pd.read_csv(csv_file, usecols=usecols))
+    for column, _, values in filters:
+        metadata = metadata.loc[metadata[column].isin(values)]
+    if columns is not None:
+        metadata = metadata[columns]
+    return metadata.reset_index(drop=True)
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files',
+                        type=str,
+                        nargs='+',
+                        default=metadata_files,
+                        help='Metadata CSV files to convert to Parquet')
+    args = parser.parse_args()
+
+    write_metadata_store(args.files)
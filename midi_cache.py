@@ -0,0 +1,169 @@
+import os
+import numpy as np
+import pretty_midi as pm
+
+from utilities import file_hash, atomic_write
+
+## Parsed MIDI files are stored as .npz archives keyed by the sha1 of the MIDI
+## file, so a modified MIDI file never hits a stale entry. Old entries are
+## evicted (least recently used first) once the cache grows over max_bytes.
+MIDI_CACHE_DIR = os.path.join('.cache', 'midi')
+MIDI_CACHE_MAX_BYTES = 2 * 1024 ** 3
+MIDI_CACHE_VERSION = 2  # bump when the parsed format changes
+EVICTION_INTERVAL = 100  # check the cache size every n writes
+
+_writes_since_eviction = 0
+
+note_dtype = np.dtype([
+    ('start', 'f8'),  # onset time in seconds
+    ('end', 'f8'),  # offset time in seconds
+    ('pitch', 'u1'),
+    ('velocity', 'u1'),
+    ('instrument', 'u2'),  # index into instruments
+])
+control_change_dtype = np.dtype([
+    ('time', 'f8'),
+    ('number', 'u1'),
+    ('value', 'u1'),
+    ('instrument', 'u2'),
+])
+instrument_dtype = np.dtype([
+    ('program', 'u1'),
+    ('is_drum', '?'),
+    ('end_time', 'f8'),  # last note, control change or pitch bend of the instrument
+])
+time_signature_dtype = np.dtype([
+    ('time', 'f8'),
+    ('numerator', 'u2'),
+    ('denominator', 'u2'),
+])
+key_signature_dtype = np.dtype([
+    ('time', 'f8'),
+    ('key_number', 'u1'),
+])
+
+def parse_midi(midi_data):
+    # PrettyMIDI object (or MIDI file) to a dict of numpy arrays
+    if not isinstance(midi_data, pm.PrettyMIDI):
+        midi_data = pm.PrettyMIDI(midi_data)
+
+    notes = np.array([(note.start, note.end, note.pitch, note.velocity, ii)
+                        for ii, inst in enumerate(midi_data.instruments) for note in inst.notes], dtype=note_dtype)
+    control_changes = np.array([(cc.time, cc.number, cc.value, ii)
+                        for ii, inst in enumerate(midi_data.instruments) for cc in inst.control_changes], dtype=control_change_dtype)
+    instruments = np.array([(inst.program, inst.is_drum, inst.get_end_time()) for inst in midi_data.instruments], dtype=instrument_dtype)
+    time_signatures = np.array([(ts.time, ts.numerator, ts.denominator) for ts in midi_data.time_signature_changes], dtype=time_signature_dtype)
+    key_signatures = np.array([(ks.time, ks.key_number) for ks in midi_data.key_signature_changes], dtype=key_signature_dtype)
+
+    # tempo map: tick scale (seconds per tick) starting from each tempo change tick
+    tempo_ticks = np.array([tick for tick, _ in midi_data._tick_scales], dtype=np.int64)
+    tick_scales = np.array([scale for _, scale in midi_data._tick_scales], dtype=np.float64)
+
+    return {
+        'notes': notes,
+        'control_changes': control_changes,
+        'instruments': instruments,
+        'time_signatures': time_signatures,
+        'key_signatures': key_signatures,
+        'resolution': np.array(midi_data.resolution),
+        'tempo_ticks': tempo_ticks,
+        'tick_scales': tick_scales,
+        'tempo_times': tempo_times(tempo_ticks, tick_scales),
+        'tick_count': np.array(len(midi_data._PrettyMIDI__tick_to_time)),  # length of PrettyMIDI's tick to time table
+        'beats': midi_data.get_beats(),
+        'downbeats': midi_data.get_downbeats(),
+        'end_time': np.array(midi_data.get_end_time()),
+    }
+
+def tempo_times(tempo_ticks, tick_scales):
+    # time in seconds of every tempo change, accumulated the same way as PrettyMIDI
+    times = np.zeros(len(tempo_ticks))
+    for k in range(1, len(tempo_ticks)):
+        times[k] = times[k-1] + tick_scales[k-1] * (tempo_ticks[k] - tempo_ticks[k-1])
+    return times
+
+def tick_to_time(midi, ticks):
+    # vectorized PrettyMIDI.tick_to_time over an array of ticks
+    ticks = np.asarray(ticks, dtype=np.int64)
+    k = np.searchsorted(midi['tempo_ticks'], ticks, side='right') - 1
+    return midi['tempo_times'][k] + midi['tick_scales'][k] * (ticks - midi['tempo_ticks'][k])
+
+def time_to_tick(midi, times):
+    # vectorized PrettyMIDI.time_to_tick over an array of times (nearest tick, ties to the later tick)
+    times = np.asarray(times, dtype=np.float64)
+    tick_count = int(midi['tick_count'])
+    k = np.searchsorted(midi['tempo_times'], times, side='right') - 1
+    k = np.maximum(k, 0)
+    estimate = midi['tempo_ticks'][k] + (times - midi['tempo_times'][k]) / midi['tick_scales'][k]
+    ticks = np.clip(np.ceil(estimate), 0, tick_count).astype(np.int64)
+
+    # first tick whose time is >= the given time (np.searchsorted side='left' on the tick table)
+    for _ in range(2):
+        lower = np.maximum(ticks - 1, 0)
+        step_down = (ticks > 0) & (tick_to_time(midi, lower) >= times)
+        ticks = np.where(step_down, lower, ticks)
+        upper = np.minimum(ticks, tick_count - 1)
+        step_up = (ticks < tick_count) & (tick_to_time(midi, upper) < times)
+        ticks = np.where(step_up, ticks + 1, ticks)
+
+    # the previous tick wins if it is strictly closer
+    inside = ticks < tick_count
+    current = tick_to_time(midi, np.minimum(ticks, tick_count - 1))
+    previous = tick_to_time(midi, np.maximum(ticks - 1, 0))
+    take_previous = inside & (ticks > 0) & (np.abs(times - previous) < np.abs(times - current))
+    ticks = np.where(take_previous, ticks - 1, ticks)
+
+    # beyond the table, extrapolate with the final tempo
+    if not inside.all():
+        last_time = tick_to_time(midi, tick_count - 1)
+        extrapolated = np.round(tick_count - 1 + (times - last_time) / midi['tick_scales'][-1]).astype(np.int64)
+        ticks = np.where(inside, ticks, extrapolated)
+    return ticks
+
+def cache_file(midi_file, cache_dir=MIDI_CACHE_DIR):
+    key = '{}_v{}'.format(file_hash(midi_file), MIDI_CACHE_VERSION)
+    return os.path.join(cache_dir, key[:2], key + '.npz')
+
+def load_midi(midi_file, cache_dir=MIDI_CACHE_DIR, max_bytes=MIDI_CACHE_MAX_BYTES):
+    # parsed MIDI file, from the cache if possible
+    cached = cache_file(midi_file, cache_dir)
+    if os.path.exists(cached):
+        try:
+            with np.load(cached) as npz:
+                midi = dict(npz)
+            os.utime(cached)  # mark as recently used
+            return midi
+        except (OSError, ValueError):
+            pass  # broken entry, parse again
+
+    midi = parse_midi(midi_file)
+
+    save_npz(cached, midi)
+
+    global _writes_since_eviction
+    _writes_since_eviction += 1
+    if _writes_since_eviction >= EVICTION_INTERVAL:
+        evict_midi_cache(cache_dir, max_bytes)
+        _writes_since_eviction = 0
+    return midi
+
+def save_npz(path, arrays):
+    atomic_write(path, lambda tmp: np.savez(tmp, **arrays), suffix='.npz')
+
+def evict_midi_cache(cache_dir=MIDI_CACHE_DIR, max_bytes=MIDI_CACHE_MAX_BYTES):
+    # remove least recently used entries until the cache fits in max_bytes
+    entries = []
+    for root, _, files in os.walk(cache_dir):
+        for f in files:
+            if f.endswith('.npz'):
+                stat = os.stat(os.path.join(root, f))
+                entries.append((stat.st_mtime, stat.st_size, os.path.join(root, f)))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
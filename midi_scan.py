@@ -0,0 +1,164 @@
+import struct
+import numpy as np
+
+from midi_cache import tempo_times, tick_to_time
+
+## Metadata of a MIDI file from one pass over the raw event bytes, without
+## building mido messages or PrettyMIDI notes. Instruments, notes and the end
+## time follow PrettyMIDI's rules (instruments per program/channel/track
+## created on the first completed note, control changes and pitch bends before
+## it kept as stragglers of the channel/track, tempo and signatures from track
+## 0), so scan_midi(f)['end_time'] == PrettyMIDI(f).get_end_time() and
+## scan_midi(f)['n_instruments'] == len(PrettyMIDI(f).instruments).
+##
+## Returned dict: resolution, n_tracks, n_instruments, n_notes, end_time,
+## tempo_changes [(time, bpm)], time_signatures [(time, numerator,
+## denominator)], key_signatures [(time, key_number)].
+
+def read_variable_int(data, position):
+    value = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value = (value << 7) | (byte & 0x7F)
+        if byte < 0x80:
+            return value, position
+
+def key_number(sharps, minor):
+    # PrettyMIDI key number (0-11 major keys from C, 12-23 minor keys) of a key signature
+    if minor:
+        return (sharps * 7 + 9) % 12 + 12
+    return (sharps * 7) % 12
+
+def scan_midi(midi_file):
+    with open(midi_file, 'rb') as f:
+        data = f.read()
+    if data[:4] != b'MThd':
+        raise ValueError('MThd not found. Probably not a MIDI file: {}'.format(midi_file))
+    header_size = struct.unpack('>L', data[4:8])[0]
+    _, n_tracks, resolution = struct.unpack('>hhh', data[8:14])
+    if resolution <= 0:
+        raise ValueError('SMPTE time division is not supported: {}'.format(midi_file))
+
+    tempo_events = []  # (tick, tempo) on track 0
+    time_signature_events = []  # (tick, numerator, denominator) on track 0
+    key_signature_events = []  # (tick, key number) on track 0
+    meta_ticks = []  # lyrics and text events on all tracks
+    instruments = {}  # (program, channel, track) -> [last note end tick, event list id]
+    stragglers = {}  # (channel, track) -> event list id
+    event_list_ticks = []  # last tick of every list of control changes / pitch bends
+    n_notes = 0
+
+    position = 8 + header_size
+    for track in range(n_tracks):
+        if data[position:position+4] != b'MTrk':
+            raise ValueError('No MTrk header at start of track: {}'.format(midi_file))
+        track_end = position + 8 + struct.unpack('>L', data[position+4:position+8])[0]
+        position += 8
+        tick = 0
+        last_status = None
+        last_note_on = {}  # (channel, note) -> note on ticks
+        current_program = [0] * 16
+
+        while position < track_end:
+            delta, position = read_variable_int(data, position)
+            tick += delta
+            status = data[position]
+            if status < 0x80:  # running status
+                status = last_status
+            else:
+                position += 1
+                if status != 0xFF:  # meta messages don't set running status
+                    last_status = status
+
+            if status == 0xFF:
+                meta_type = data[position]
+                length, position = read_variable_int(data, position + 1)
+                payload = data[position:position+length]
+                position += length
+                if meta_type == 0x51 and track == 0:
+                    tempo_events.append((tick, (payload[0] << 16) | (payload[1] << 8) | payload[2]))
+                elif meta_type == 0x58 and track == 0:
+                    time_signature_events.append((tick, payload[0], 2 ** payload[1]))
+                elif meta_type == 0x59 and track == 0:
+                    sharps = payload[0] - 256 if payload[0] > 127 else payload[0]
+                    key_signature_events.append((tick, key_number(sharps, payload[1])))
+                elif meta_type in (0x01, 0x05):  # text, lyrics
+                    meta_ticks.append(tick)
+                continue
+            if status in (0xF0, 0xF7):
+                length, position = read_variable_int(data, position)
+                position += length
+                continue
+
+            kind, channel = status & 0xF0, status & 0x0F
+            if kind in (0xC0, 0xD0):
+                data1 = data[position]
+                position += 1
+                if kind == 0xC0:
+                    current_program[channel] = data1
+                continue
+            data1, data2 = data[position], data[position+1]
+            position += 2
+
+            if kind == 0x90 and data2 > 0:
+                last_note_on.setdefault((channel, data1), []).append(tick)
+            elif kind == 0x80 or kind == 0x90:
+                open_notes = last_note_on.get((channel, data1))
+                if open_notes is None:
+                    continue  # spurious note off
+                n_close = sum(1 for start_tick in open_notes if start_tick != tick)
+                if n_close:
+                    # notes are added to the instrument of the current program, created if needed
+                    key = (current_program[channel], channel, track)
+                    if key not in instruments:
+                        if (channel, track) in stragglers:
+                            list_id = stragglers[(channel, track)]
+                        else:
+                            list_id = len(event_list_ticks)
+                            event_list_ticks.append(-1)
+                        instruments[key] = [-1, list_id]
+                    instruments[key][0] = max(instruments[key][0], tick)
+                    n_notes += n_close
+                if n_close and n_close < len(open_notes):
+                    last_note_on[(channel, data1)] = [start_tick for start_tick in open_notes if start_tick == tick]
+                else:
+                    del last_note_on[(channel, data1)]
+            elif kind in (0xB0, 0xE0):  # control change, pitch bend
+                key = (current_program[channel], channel, track)
+                if key in instruments:
+                    list_id = instruments[key][1]
+                elif (channel, track) in stragglers:
+                    list_id = stragglers[(channel, track)]
+                else:
+                    list_id = stragglers[(channel, track)] = len(event_list_ticks)
+                    event_list_ticks.append(-1)
+                event_list_ticks[list_id] = max(event_list_ticks[list_id], tick)
+        position = track_end
+
+    # tick scales as PrettyMIDI: a tempo at tick 0 replaces the default, repeated tempi are skipped
+    tick_scales = [(0, 60.0 / (120.0 * resolution))]
+    for tick, tempo in tempo_events:
+        tick_scale = 60.0 / ((6e7 / tempo) * resolution)
+        if tick == 0:
+            tick_scales = [(0, tick_scale)]
+        elif tick_scale != tick_scales[-1][1]:
+            tick_scales.append((tick, tick_scale))
+    tempo_ticks = np.array([tick for tick, _ in tick_scales], dtype=np.int64)
+    scales = np.array([scale for _, scale in tick_scales], dtype=np.float64)
+    timing = {'tempo_ticks': tempo_ticks, 'tick_scales': scales, 'tempo_times': tempo_times(tempo_ticks, scales)}
+
+    end_ticks = [note_tick for note_tick, _ in instruments.values() if note_tick >= 0]
+    end_ticks += [event_list_ticks[list_id] for _, list_id in instruments.values() if event_list_ticks[list_id] >= 0]
+    end_ticks += [tick for tick, _, _ in time_signature_events] + [tick for tick, _ in key_signature_events] + meta_ticks
+    end_ticks += tempo_ticks.tolist()
+    return {
+        'resolution': resolution,
+        'n_tracks': n_tracks,
+        'n_instruments': len(instruments),
+        'n_notes': n_notes,
+        'end_time': float(tick_to_time(timing, max(end_ticks))) if end_ticks else 0.,
+        'tempo_changes': list(zip(timing['tempo_times'].tolist(), (60. / (scales * resolution)).tolist())),
+        'time_signatures': [(float(tick_to_time(timing, tick)), numerator, denominator) for tick, numerator, denominator in time_signature_events],
+        'key_signatures': [(float(tick_to_time(timing, tick)), number) for tick, number in key_signature_events],
+    }
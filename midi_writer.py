@@ -0,0 +1,136 @@
+import struct
+import numpy as np
+import mido
+
+## MIDI file writer working on event arrays. The events of a track are
+## sorted with a stable lexsort on (tick, key), where key is the secondary
+## sort value of the PrettyMIDI.write comparator (event type rank * 256 * 256
+## + type specific fields), then delta times and the track bytes are encoded
+## as arrays. The bytes are the same as building the track with mido messages,
+## sorting with that comparator and saving with mido (running status
+## included). Meta events are few and are encoded by mido.
+##
+##   track = encode_track(note_events(starts, ends, pitches, velocities), [meta_event(0, 'track_name', name='Piano')])
+##   write_midi('out.mid', [timing_track, track], ticks_per_beat=220)
+secondary_sort_ranks = {
+    'track_name': 0,  # no rank in the comparator (compared by time only), always added first
+    'set_tempo': 1,
+    'time_signature': 2,
+    'key_signature': 3,
+    'lyrics': 4,
+    'program_change': 6,
+    'pitchwheel': 7,
+    'control_change': 8,
+    'note_off': 9,
+    'note_on': 10,
+}
+channel_event_dtype = np.dtype([
+    ('tick', 'i8'),  # absolute
+    ('key', 'i8'),  # secondary sort value
+    ('status', 'u1'),
+    ('data1', 'u1'),
+    ('data2', 'u1'),
+])
+
+def sort_key(event_type, secondary=0):
+    return secondary_sort_ranks[event_type] * 256 * 256 + secondary
+
+def channel_events(ticks, key, status, data1, data2=0):
+    ticks = np.asarray(ticks, dtype=np.int64)
+    events = np.zeros(len(ticks), dtype=channel_event_dtype)
+    events['tick'] = ticks
+    events['key'] = key
+    events['status'] = status
+    events['data1'] = data1
+    events['data2'] = data2
+    return events
+
+def note_events(starts, ends, pitches, velocities, channel=0, note_off_first=False):
+    # note on and note off (note on with velocity 0) of every note, in that order. With note_off_first,
+    # note offs sort before all note ons at the same tick, otherwise with the note ons by pitch.
+    pitches = np.asarray(pitches, dtype=np.int64)
+    velocities = np.asarray(velocities, dtype=np.int64)
+    ticks = np.stack([starts, ends], axis=1).reshape(-1)
+    on_keys = sort_key('note_on', pitches * 256 + velocities)
+    off_keys = sort_key('note_off', pitches * 256) if note_off_first else sort_key('note_on', pitches * 256)
+    keys = np.stack([on_keys, off_keys], axis=1).reshape(-1)
+    velocities = np.stack([velocities, np.zeros_like(velocities)], axis=1).reshape(-1)
+    return channel_events(ticks, keys, 0x90 | channel, np.repeat(pitches, 2), velocities)
+
+def control_change_events(ticks, numbers, values, channel=0):
+    numbers = np.asarray(numbers, dtype=np.int64)
+    values = np.asarray(values, dtype=np.int64)
+    return channel_events(ticks, sort_key('control_change', numbers * 256 + values), 0xB0 | channel, numbers, values)
+
+def program_change_events(ticks, programs, channel=0):
+    return channel_events(ticks, sort_key('program_change'), 0xC0 | channel, programs)
+
+def meta_event(tick, event_type, **kwargs):
+    # (tick, key, bytes) of a meta message, e.g. meta_event(0, 'set_tempo', tempo=500000)
+    return (int(tick), sort_key(event_type), bytes(mido.MetaMessage(event_type, **kwargs).bytes()))
+
+def variable_int_sizes(values):
+    return 1 + (values >= 1 << 7) + (values >= 1 << 14) + (values >= 1 << 21)
+
+def encode_track(events=None, meta_events=()):
+    # MTrk chunk of the sorted events, ending one tick after the last event
+    events = np.zeros(0, dtype=channel_event_dtype) if events is None else events
+    n_meta = len(meta_events)
+    ticks = np.r_[np.array([e[0] for e in meta_events], dtype=np.int64), events['tick']]
+    keys = np.r_[np.array([e[1] for e in meta_events], dtype=np.int64), events['key']]
+    order = np.lexsort((keys, ticks))  # stable: meta events first, then channel events in the given order
+    ticks = ticks[order]
+    is_meta = order < n_meta
+    channel_index = np.maximum(order - n_meta, 0)
+    status = np.where(is_meta, 0xFF, events['status'][channel_index] if len(events) else 0).astype(np.int64)
+    data1 = events['data1'][channel_index] if len(events) else np.zeros(len(order), dtype=np.uint8)
+    data2 = events['data2'][channel_index] if len(events) else np.zeros(len(order), dtype=np.uint8)
+    n_data = np.where((status & 0xE0) == 0xC0, 1, 2)  # program change / channel pressure have one data byte
+
+    # running status: channel messages repeating the status of the previous channel message
+    running = np.zeros(len(order), dtype=bool)
+    running[1:] = ~is_meta[1:] & ~is_meta[:-1] & (status[1:] == status[:-1])
+
+    deltas = np.diff(ticks, prepend=0)
+    delta_sizes = variable_int_sizes(deltas)
+    meta_sizes = np.array([len(meta_events[i][2]) for i in order[is_meta]], dtype=np.int64)
+    body_sizes = np.where(running, 0, 1) + n_data
+    body_sizes[is_meta] = meta_sizes
+    offsets = np.r_[0, np.cumsum(delta_sizes + body_sizes)]
+    data = np.zeros(offsets[-1], dtype=np.uint8)
+
+    # delta times, 7 bits per byte with the high bit set on all but the last byte
+    starts = offsets[:-1]
+    for k in range(4):
+        has_byte = delta_sizes > k
+        shift = 7 * (delta_sizes[has_byte] - 1 - k)
+        data[starts[has_byte] + k] = (deltas[has_byte] >> shift) & 0x7F | np.where(delta_sizes[has_byte] - 1 > k, 0x80, 0)
+
+    # channel messages
+    body_starts = starts + delta_sizes
+    channel, written_status = ~is_meta, ~is_meta & ~running
+    data[body_starts[written_status]] = status[written_status]
+    data1_positions = body_starts + np.where(running, 0, 1)
+    data[data1_positions[channel]] = data1[channel]
+    has_data2 = channel & (n_data == 2)
+    data[data1_positions[has_data2] + 1] = data2[has_data2]
+
+    # meta messages
+    for position, i in zip(body_starts[is_meta].tolist(), order[is_meta].tolist()):
+        data[position:position+len(meta_events[i][2])] = np.frombuffer(meta_events[i][2], dtype=np.uint8)
+
+    data = data.tobytes() + b'\x01\xff\x2f\x00'  # end of track
+    return b'MTrk' + struct.pack('>L', len(data)) + data
+
+def write_midi(filename, tracks, ticks_per_beat):
+    # type 1 MIDI file of encoded tracks
+    with open(filename, 'wb') as f:
+        f.write(b'MThd' + struct.pack('>L', 6) + struct.pack('>hhh', 1, len(tracks), ticks_per_beat))
+        for track in tracks:
+            f.write(track)
+
+def ticks_at_tempo(times, resolution=220, initial_tempo=120.):
+    # PrettyMIDI.time_to_tick of a new PrettyMIDI(resolution, initial_tempo) object (no tempo changes)
+    times = np.asarray(times, dtype=np.float64)
+    tick_scale = 60.0 / (initial_tempo * resolution)
+    return np.where(times > 0, np.round(times / tick_scale), 0).astype(np.int64)
@@ -0,0 +1,163 @@
+import os
+import functools
+import numpy as np
+
+from utilities import load_path, file_hash, metadata_map
+from midi_cache import load_midi, save_npz
+
+## Piano rolls stored as merged note intervals in frames, one (pitch, start,
+## end) record per run of active frames of a pitch. They are computed from
+## the cached note arrays with the same framing and sustain pedal handling as
+## PrettyMIDI.get_piano_roll(fs, pedal_threshold) > 0 (pitch bends are not
+## rendered, there are none in piano files), and densified only for the
+## frames a caller asks for.
+PIANOROLL_STORE_DIR = os.path.join('.cache', 'pianoroll')
+PIANOROLL_STORE_VERSION = 1
+PIANOROLL_PEDAL_THRESHOLDS = (64, 128)  # stored by build_pianoroll_store: with pedal, without pedal
+
+interval_dtype = np.dtype([
+    ('pitch', 'u1'),
+    ('start', 'i8'),  # first active frame
+    ('end', 'i8'),  # frame after the last active frame
+])
+FRAME_LIMIT = 1 << 40  # larger than any frame index, used to keep pitches apart when merging
+
+def merge_intervals(pitch, start, end):
+    # union of the intervals of each pitch, sorted by pitch and start
+    keep = end > start
+    pitch, start, end = pitch[keep].astype(np.int64), start[keep], end[keep]
+    if len(pitch) == 0:
+        return np.zeros(0, dtype=interval_dtype)
+    order = np.lexsort((start, pitch))
+    pitch, start, end = pitch[order], start[order], end[order]
+
+    # offset each pitch so the running maximum of the ends never crosses pitches
+    start_key = pitch * FRAME_LIMIT + start
+    end_key = np.maximum.accumulate(pitch * FRAME_LIMIT + end)
+    new_run = np.ones(len(pitch), dtype=bool)
+    new_run[1:] = start_key[1:] > end_key[:-1]
+    run_starts = np.flatnonzero(new_run)
+    run_ends = np.r_[run_starts[1:], len(pitch)] - 1
+
+    intervals = np.zeros(len(run_starts), dtype=interval_dtype)
+    intervals['pitch'] = pitch[run_starts]
+    intervals['start'] = start[run_starts]
+    intervals['end'] = end_key[run_ends] - pitch[run_starts] * FRAME_LIMIT
+    return intervals
+
+def pedal_windows(control_changes, fs, pedal_threshold):
+    # (on, off) frames of the sustain pedal, as PrettyMIDI applies them
+    windows = []
+    time_pedal_on, is_pedal_on = 0, False
+    for cc in control_changes[control_changes['number'] == 64]:
+        time_now = int(cc['time'] * fs)
+        is_current_pedal_on = cc['value'] >= pedal_threshold
+        if not is_pedal_on and is_current_pedal_on:
+            time_pedal_on, is_pedal_on = time_now, True
+        elif is_pedal_on and not is_current_pedal_on:
+            windows.append((time_pedal_on, time_now))
+            is_pedal_on = False
+    return np.array(windows, dtype=np.int64).reshape(-1, 2)
+
+def apply_pedal(intervals, windows, length):
+    # a pitch active anywhere in a pedal window stays active until the pedal is released
+    if len(intervals) == 0 or len(windows) == 0:
+        return intervals
+    ons, offs = windows[:, 0], np.minimum(windows[:, 1], length)
+    # windows each interval overlaps: lo .. hi-1
+    lo = np.searchsorted(offs, intervals['start'], side='right')
+    hi = np.searchsorted(ons, intervals['end'], side='left')
+    counts = np.maximum(hi - lo, 0)
+    interval_index = np.repeat(np.arange(len(intervals)), counts)
+    window_index = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(lo, counts)
+    extension_start = np.maximum(intervals['start'][interval_index], ons[window_index])
+    extension_end = offs[window_index]
+    return merge_intervals(np.r_[intervals['pitch'], intervals['pitch'][interval_index]],
+                            np.r_[intervals['start'], extension_start],
+                            np.r_[intervals['end'], extension_end])
+
+def compute_pianoroll(midi, fs=100, pedal_threshold=64):
+    # (intervals, length in frames) of a parsed MIDI file, pedal_threshold=None ignores the pedal
+    notes, control_changes = midi['notes'], midi['control_changes']
+    intervals_all, length = [], 0
+    for ii, inst in enumerate(midi['instruments']):
+        inst_notes = notes[notes['instrument'] == ii]
+        if len(inst_notes) == 0:
+            continue
+        inst_length = int(fs * inst['end_time'])
+        length = max(length, inst_length)
+        if inst['is_drum']:
+            continue
+        inst_notes = inst_notes[inst_notes['velocity'] > 0]
+        start = (inst_notes['start'] * fs).astype(np.int64)
+        end = np.minimum((inst_notes['end'] * fs).astype(np.int64), inst_length)
+        intervals = merge_intervals(inst_notes['pitch'], start, end)
+        if pedal_threshold is not None:
+            windows = pedal_windows(control_changes[control_changes['instrument'] == ii], fs, pedal_threshold)
+            intervals = apply_pedal(intervals, windows, inst_length)
+        intervals_all.append(intervals)
+    if not intervals_all:
+        return np.zeros(0, dtype=interval_dtype), length
+    intervals = np.concatenate(intervals_all)
+    return merge_intervals(intervals['pitch'], intervals['start'], intervals['end']), length
+
+def store_file(midi_file, fs, pedal_threshold, store_dir=PIANOROLL_STORE_DIR):
+    key = '{}_fs{}_pedal{}_v{}'.format(file_hash(midi_file), fs, pedal_threshold, PIANOROLL_STORE_VERSION)
+    return os.path.join(store_dir, key[:2], key + '.npz')
+
+def load_pianoroll(midi_file, fs=100, pedal_threshold=64, store_dir=PIANOROLL_STORE_DIR):
+    # (intervals, length) of a MIDI file, computed and stored on first use
+    stored = store_file(midi_file, fs, pedal_threshold, store_dir)
+    if os.path.exists(stored):
+        with np.load(stored) as npz:
+            return npz['intervals'], int(npz['length'])
+    intervals, length = compute_pianoroll(load_midi(midi_file), fs, pedal_threshold)
+    save_npz(stored, {'intervals': intervals, 'length': np.array(length)})
+    return intervals, length
+
+def to_dense(intervals, length, start_frame=0, end_frame=None):
+    # boolean (128, frames) piano roll of frames start_frame .. end_frame-1
+    end_frame = length if end_frame is None else end_frame
+    n = max(end_frame - start_frame, 0)
+    start = np.clip(intervals['start'], start_frame, end_frame) - start_frame
+    end = np.clip(intervals['end'], start_frame, end_frame) - start_frame
+    keep = end > start
+    diff = np.zeros((128, n + 1), dtype=np.int32)
+    np.add.at(diff, (intervals['pitch'][keep], start[keep]), 1)
+    np.add.at(diff, (intervals['pitch'][keep], end[keep]), -1)
+    return np.cumsum(diff[:, :n], axis=1) > 0
+
+def slice_pianoroll(intervals, length, start_time, end_time, fs=100):
+    # dense piano roll between two times in seconds
+    return to_dense(intervals, length, int(start_time * fs), int(end_time * fs))
+
+def polyphony(intervals, length):
+    # number of active pitches in every frame
+    diff = np.zeros(length + 1, dtype=np.int64)
+    np.add.at(diff, np.minimum(intervals['start'], length), 1)
+    np.add.at(diff, np.minimum(intervals['end'], length), -1)
+    return np.cumsum(diff[:length])
+
+def polyphony_histogram(intervals, length):
+    # number of frames at every polyphony level (0 to 128 pitches), from the interval boundaries only,
+    # the same as np.bincount(polyphony(intervals, length), minlength=129) without per-frame arrays
+    positions = np.minimum(np.r_[intervals['start'], intervals['end']], length)
+    changes = np.r_[np.ones(len(intervals), dtype=np.int64), -np.ones(len(intervals), dtype=np.int64)]
+    order = np.argsort(positions, kind='stable')
+    positions = np.r_[0, positions[order]]
+    levels = np.r_[0, np.cumsum(changes[order])]
+    frames = np.diff(np.r_[positions, length])
+    return np.bincount(levels, weights=frames, minlength=129).astype(np.int64)
+
+def store_row_pianorolls(row, fs_list, pedal_thresholds):
+    for column in ['performance_MIDI', 'MIDI_score']:
+        midi_file = os.path.join(load_path(row['folder']), row[column])
+        for fs in fs_list:
+            for pedal_threshold in pedal_thresholds:
+                load_pianoroll(midi_file, fs, pedal_threshold)
+
+def build_pianoroll_store(metadata, subset, fs_list=(100,), pedal_thresholds=PIANOROLL_PEDAL_THRESHOLDS, workers=None, chunksize=1):
+    # piano rolls of every performance MIDI and MIDI score
+    print('\nBuild piano roll store...', subset)
+    metadata_map(functools.partial(store_row_pianorolls, fs_list=fs_list, pedal_thresholds=pedal_thresholds),
+                metadata, workers=workers, chunksize=chunksize)
@@ -0,0 +1,29 @@
+import heapq
+import numpy as np
+
+## Maximum polyphony constraint on note arrays (midi_cache.note_dtype).
+## Notes are swept in order of onset with a heap of the end times of the
+## sounding notes: a note is kept if fewer than poly_level notes are still
+## sounding at its onset (notes ending at the onset are released first).
+## Notes starting together are taken in tie-break order, so the order decides
+## which of them are dropped.
+tie_breaks = {
+    'lowest_pitch': lambda notes: notes['pitch'],
+    'highest_pitch': lambda notes: -notes['pitch'].astype(np.int64),
+    'highest_velocity': lambda notes: -notes['velocity'].astype(np.int64),
+    'lowest_velocity': lambda notes: notes['velocity'],
+}
+
+def polyphony_keep_mask(notes, poly_level, tie_break='lowest_pitch'):
+    # boolean mask of the notes kept under the polyphony limit
+    order = np.lexsort((tie_breaks[tie_break](notes), notes['start']))
+    starts, ends = notes['start'][order].tolist(), notes['end'][order].tolist()
+    keep = np.zeros(len(notes), dtype=bool)
+    sounding = []  # end times
+    for i, start, end in zip(order.tolist(), starts, ends):
+        while sounding and sounding[0] <= start:
+            heapq.heappop(sounding)
+        if len(sounding) < poly_level:
+            heapq.heappush(sounding, end)
+            keep[i] = True
+    return keep
@@ -0,0 +1,34 @@
+import numpy as np
+
+from midi_cache import time_to_tick, tick_to_time
+
+## Quantization of note arrays (midi_cache.note_dtype) to a coarser tick
+## grid, the same as quantizing note by note with PrettyMIDI time_to_tick /
+## tick_to_time: times are converted through the cached tempo map in both
+## directions, and notes collapsed to zero length are dropped with a mask.
+
+def quantize_ticks(ticks, resolution_large, resolution_small):
+    # ticks at resolution_large floored to the grid of resolution_small ticks per beat
+    step = resolution_large / resolution_small
+    return np.round(np.asarray(ticks) // step * step).astype(np.int64)
+
+def quantize_times(midi, times, resolution):
+    ticks = time_to_tick(midi, times)
+    return tick_to_time(midi, quantize_ticks(ticks, int(midi['resolution']), resolution))
+
+def quantize_notes(midi, notes, resolution):
+    # quantized copy of the notes, without the notes that start at or after their end
+    notes = notes.copy()
+    notes['start'] = quantize_times(midi, notes['start'], resolution)
+    notes['end'] = quantize_times(midi, notes['end'], resolution)
+    return notes[notes['start'] < notes['end']]
+
+def with_notes(midi, notes):
+    # parsed MIDI with other notes, instrument end times updated from the notes and control
+    # changes (pitch bends are not cached, they only matter for the piano roll length)
+    instruments = midi['instruments'].copy()
+    end_times = np.zeros(len(instruments))
+    np.maximum.at(end_times, notes['instrument'], notes['end'])
+    np.maximum.at(end_times, midi['control_changes']['instrument'], midi['control_changes']['time'])
+    instruments['end_time'] = end_times
+    return dict(midi, notes=notes, instruments=instruments)
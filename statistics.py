@@ -1,107 +1,248 @@
 import os
+import argparse
+import hashlib
+import itertools
 import pandas as pd
-import pretty_midi as pm
-import librosa
+import numpy as np
 import json
 
+from utilities import load_path, mkdir, file_hash, metadata_map, process_map, save_json
+from audio_io import audio_duration
+from midi_scan import scan_midi
 
-def print_statistics():
-
-    metadata_R = pd.read_csv('metadata_R.csv')
-    metadata_S = pd.read_csv('metadata_S.csv')
-
-    statistics = pd.DataFrame(columns=[
-        'Subset',
-        'Source',
-        'Split',
-        'Pieces',
-        'Performances',
-        'Duration (hours)',
-    ])
-    metadata_R_MAPS = metadata_R.loc[metadata_R['source'] == 'MAPS']
-    metadata_R_ASAP = metadata_R.loc[metadata_R['source'] == 'ASAP']
-
-    metadata_R_ASAP_train = metadata_R_ASAP.loc[metadata_R_ASAP['split'] == 'train']
-    metadata_R_ASAP_validation = metadata_R_ASAP.loc[metadata_R_ASAP['split'] == 'validation']
-    metadata_R_ASAP_test = metadata_R_ASAP.loc[metadata_R_ASAP['split'] == 'test']
-
-    metadata_S_train = metadata_S.loc[metadata_S['split'] == 'train']
-    metadata_S_validation = metadata_S.loc[metadata_S['split'] == 'validation']
-    metadata_S_test = metadata_S.loc[metadata_S['split'] == 'test']
-
-    metadata_all_train = pd.concat([metadata_R_ASAP_train, metadata_S_train], ignore_index=True)
-    metadata_all_validation = pd.concat([metadata_R_ASAP_validation, metadata_S_validation], ignore_index=True)
-    metadata_all_test = pd.concat([metadata_R_MAPS, metadata_R_ASAP_test, metadata_S_test], ignore_index=True)
-    metadata_all = pd.concat([metadata_R, metadata_S], ignore_index=True)
-
-    for subset, source, split, metadata in [('Real recording', 'MAPS', 'test', metadata_R_MAPS),
-                                            ('Real recording', 'ASAP', 'train', metadata_R_ASAP_train),
-                                            ('Real recording', 'ASAP', 'validation', metadata_R_ASAP_validation),
-                                            ('Real recording', 'ASAP', 'test', metadata_R_ASAP_test),
-                                            ('Real recording', 'Total', '--', metadata_R),
-                                            ('Synthetic', '--', 'train', metadata_S_train),
-                                            ('Synthetic', '--', 'validation', metadata_S_validation),
-                                            ('Synthetic', '--', 'test', metadata_S_test),
-                                            ('Synthetic', '--', 'Total', metadata_S),
-                                            ('Both', '--', 'train', metadata_all_train),
-                                            ('Both', '--', 'validation', metadata_all_validation),
-                                            ('Both', '--', 'test', metadata_all_test),
-                                            ('Both', '--', 'Total', metadata_all)]:
-        statistics = statistics.append({
-            'Subset': subset,
-            'Source': source,
-            'Split': split,
-            'Pieces': len(set(metadata['piece_id'])),
-            'Performances': len(metadata),
-            'Duration (hours)': metadata['duration'].sum() / 3600,
-        }, ignore_index=True)
-    
-    print(statistics)
-
-def statistics_other_datasets():
-    MAPS = '/import/c4dm-01/MAPS_original'
-    A_MAPS = '/import/c4dm-datasets/A2S_transcription/working/A-MAPS_1.1/midi/'
-    ASAP = '/import/c4dm-datasets/ASAP_dataset/asap-dataset-1.1'
-
-    print('MAPS dataset:')
-    n, duration = 0, 0
-    MAPS_subsets = [f for f in os.listdir(MAPS) if os.path.isdir(os.path.join(MAPS, f))]
-    for subset in MAPS_subsets:
-        for item in os.listdir(os.path.join(MAPS, subset, 'MUS')):
-            if item[-4:] == '.wav':
-                y, fs = librosa.load(os.path.join(MAPS, subset, 'MUS', item))
-                n += 1
-                duration += len(y) / fs
-                print(n, end='\r')
-    print('\n, n:', n, 'duration:', duration / 3600)
-
-    print('A-MAPS dataset:')
-    n, duration = 0, 0
-    for item in os.listdir(A_MAPS):
-        midi_data = pm.PrettyMIDI(os.path.join(A_MAPS, item))
-        n += 1
-        duration += midi_data.get_end_time()
-        print(n, end='\r')
-    print('\n n:', n, 'duration:', duration / 3600)
-
-    print('ASAP dataset:')
-    n, duration = 0, 0
-    n_audio, duration_audio = 0, 0
+
+## Statistics cube: pieces, performances, duration and note counts of the
+## metadata for every combination of the dimensions (default subset x source
+## x split), rolled up over any subset of them ('Total'). The metadata is
+## grouped once by all dimensions and piece, and every rollup aggregates that
+## piece-level table. Note counts come from midi_scan and the cube is cached
+## against the hash of the metadata files.
+##
+##   python statistics.py --dimensions subset source split composer
+STATISTICS_CACHE_DIR = os.path.join('.cache', 'statistics')
+STATISTICS_CACHE_VERSION = 1
+METADATA_FILES = ['metadata_R.csv', 'metadata_S.csv']
+subset_names = {'R': 'Real recording', 'S': 'Synthetic'}
+cube_columns = ['pieces', 'performances', 'duration', 'mean_duration', 'notes', 'mean_notes']  # duration in hours, mean in seconds
+
+# rows of the README table, as (subset, source, split) of the cube and the labels of the table
+readme_rows = [
+    [(('Real recording', 'MAPS', 'test'), ('Real recording', 'MAPS', 'test')),
+     (('Real recording', 'ASAP', 'train'), ('Real recording', 'ASAP', 'train')),
+     (('Real recording', 'ASAP', 'validation'), ('Real recording', 'ASAP', 'validation')),
+     (('Real recording', 'ASAP', 'test'), ('Real recording', 'ASAP', 'test')),
+     (('Real recording', 'Total', 'Total'), ('Real recording', 'Both', 'Total'))],
+    [(('Synthetic', 'Total', 'train'), ('Synthetic', '--', 'train')),
+     (('Synthetic', 'Total', 'validation'), ('Synthetic', '--', 'validation')),
+     (('Synthetic', 'Total', 'test'), ('Synthetic', '--', 'test')),
+     (('Synthetic', 'Total', 'Total'), ('Synthetic', '--', 'Total'))],
+    [(('Total', 'Total', 'train'), ('Both', '--', 'train')),
+     (('Total', 'Total', 'validation'), ('Both', '--', 'validation')),
+     (('Total', 'Total', 'test'), ('Both', '--', 'test')),
+     (('Total', 'Total', 'Total'), ('Both', '--', 'Total'))],
+]
+readme_header = ['Subset', 'Source', 'Split', 'Distinct Pieces', 'Performances', 'Duration (hours)']
+readme_widths = [16, 8, 12, 17, 14, 18]
+# value cells start where a value of this width would be centered (0: centered on their own width),
+# the Distinct Pieces column of the README is laid out for two-digit counts, longer ones extend to the right
+readme_value_widths = [0, 0, 0, 2, 0, 0]
+
+def metadata_hash(metadata_files=METADATA_FILES):
+    h = hashlib.sha1(str(STATISTICS_CACHE_VERSION).encode())
+    for metadata_file in metadata_files:
+        h.update(file_hash(metadata_file).encode())
+    return h.hexdigest()
+
+def load_statistics_metadata(metadata_files=METADATA_FILES):
+    # all performances, with the subset and the piano (Kontakt piano font of synthesized audio, '--' otherwise)
+    metadata = pd.concat([pd.read_csv(f) for f in metadata_files], ignore_index=True)
+    metadata['subset'] = metadata['performance_id'].str[0].map(subset_names)
+    metadata['piano'] = [a[:-4].split('_Kontakt_')[1] if '_Kontakt_' in a else '--' for a in metadata['performance_audio']]
+    return metadata
+
+def count_notes(row):
+    return scan_midi(os.path.join(load_path(row['folder']), row['performance_MIDI']))['n_notes']
+
+def note_counts(metadata, key, cache_dir=STATISTICS_CACHE_DIR, workers=None, chunksize=8):
+    # note count of every performance MIDI, cached by metadata hash
+    cached = os.path.join(cache_dir, 'notes_{}.npy'.format(key))
+    if os.path.exists(cached):
+        return np.load(cached)
+    print('Count notes...')
+    counts = np.array(metadata_map(count_notes, metadata, workers=workers, chunksize=chunksize), dtype=np.int64)
+    mkdir(cache_dir)
+    np.save(cached, counts)
+    return counts
+
+def statistics_cube(metadata, dimensions=('subset', 'source', 'split')):
+    # one row per combination of dimension values, 'Total' for rolled up dimensions
+    dimensions = list(dimensions)
+    pieces = metadata.groupby(dimensions + ['piece_id'], sort=False).agg(
+        performances=('performance_id', 'size'),
+        duration=('duration', 'sum'),
+        notes=('notes', 'sum'),
+    ).reset_index()
+
+    cube = []
+    for rolled_up in itertools.product([False, True], repeat=len(dimensions)):
+        keys = [d for d, r in zip(dimensions, rolled_up) if not r]
+        grouped = pieces.groupby(keys, sort=True) if keys else pieces.groupby(np.zeros(len(pieces)))
+        rollup = grouped.agg(
+            pieces=('piece_id', 'nunique'),
+            performances=('performances', 'sum'),
+            duration=('duration', 'sum'),
+            notes=('notes', 'sum'),
+        ).reset_index(drop=not keys)
+        for d, r in zip(dimensions, rolled_up):
+            if r:
+                rollup[d] = 'Total'
+        cube.append(rollup)
+    cube = pd.concat(cube, ignore_index=True)
+    cube['mean_duration'] = cube['duration'] / cube['performances']
+    cube['duration'] = cube['duration'] / 3600
+    cube['mean_notes'] = cube['notes'] / cube['performances']
+    return cube[dimensions + cube_columns]
+
+def load_statistics_cube(dimensions=('subset', 'source', 'split'), metadata_files=METADATA_FILES, cache_dir=STATISTICS_CACHE_DIR, workers=None):
+    # cube from the cache if the metadata files did not change
+    key = metadata_hash(metadata_files)
+    cached = os.path.join(cache_dir, 'cube_{}_{}.csv'.format(key, '-'.join(dimensions)))
+    if os.path.exists(cached):
+        return pd.read_csv(cached, keep_default_na=False, dtype=dict((d, str) for d in dimensions))
+    metadata = load_statistics_metadata(metadata_files)
+    metadata['notes'] = note_counts(metadata, key, cache_dir, workers=workers)
+    cube = statistics_cube(metadata, dimensions)
+    mkdir(cache_dir)
+    cube.to_csv(cached, index=False)
+    return cube
+
+def readme_table(cube):
+    # markdown table of the README from a subset x source x split cube
+    cube = cube.set_index(['subset', 'source', 'split'])
+    def line(cells, value_widths=[0] * len(readme_widths)):
+        lefts = [(w - (v or len(c)) + 1) // 2 for c, w, v in zip(cells, readme_widths, value_widths)]
+        return '|' + '|'.join(' ' * l + c + ' ' * (w - l - len(c)) for c, w, l in zip(cells, readme_widths, lefts)) + '|'
+    lines = [line(readme_header), '|' + '|'.join(':' + '-' * (w - 2) + ':' for w in readme_widths) + '|']
+    for i, rows in enumerate(readme_rows):
+        if i > 0:
+            lines.append(line([''] * len(readme_widths)))
+        for key, labels in rows:
+            row = cube.loc[key]
+            lines.append(line(list(labels) + [str(int(row['pieces'])), str(int(row['performances'])), '{:.6f}'.format(row['duration'])], readme_value_widths))
+    return '\n'.join(lines)
+
+def print_statistics(dimensions=('subset', 'source', 'split'), workers=None):
+    cube = load_statistics_cube(dimensions, workers=workers)
+    with pd.option_context('display.max_rows', None, 'display.width', 200):
+        print(cube)
+    if list(dimensions) == ['subset', 'source', 'split']:
+        print()
+        print(readme_table(cube))
+
+## Durations of the original MAPS, A-MAPS and ASAP datasets, from the audio
+## headers (audio_io.audio_duration) and midi_scan end times, with the files
+## of all sources scanned together in the process pool. Durations are cached
+## per file by path, size and mtime, so a repeated run only scans new or
+## changed files.
+DURATION_CACHE_FILE = os.path.join('.cache', 'statistics', 'durations.json')
+
+def MAPS_files(MAPS):
+    # (file, has audio) of the MAPS music pieces
+    files = []
+    for subset in sorted(os.listdir(MAPS)):
+        if os.path.isdir(os.path.join(MAPS, subset)):
+            for item in sorted(os.listdir(os.path.join(MAPS, subset, 'MUS'))):
+                if item[-4:] == '.wav':
+                    files.append((os.path.join(MAPS, subset, 'MUS', item), True))
+    return files
+
+def A_MAPS_files(A_MAPS):
+    return [(os.path.join(A_MAPS, item), False) for item in sorted(os.listdir(A_MAPS))]
+
+def ASAP_files(ASAP):
+    # performance MIDI files, with audio if in MAESTRO
     metadata = pd.read_csv(os.path.join(ASAP, 'metadata.csv'))
-    for i, row in metadata.iterrows():
-        midi_data = pm.PrettyMIDI(os.path.join(ASAP, row['midi_performance']))
-        d = midi_data.get_end_time()
-        n += 1
-        duration += d
-        if type(row['maestro_audio_performance']) == str:
-            n_audio += 1
-            duration_audio += d
-        print(i+1, '/', len(metadata), end='\r')
-    print('\n n:', n, 'duration:', duration / 3600)
-    print('n_audio:', n_audio, 'duration_audio:', duration_audio / 3600)
+    return [(os.path.join(ASAP, row['midi_performance']), type(row['maestro_audio_performance']) == str)
+            for row in metadata.to_dict('records')]
 
+source_scanners = {
+    'MAPS': MAPS_files,
+    'A_MAPS': A_MAPS_files,
+    'ASAP': ASAP_files,
+}
+
+def file_duration(path):
+    if path.lower().endswith(('.mid', '.midi')):
+        return scan_midi(path)['end_time']
+    return audio_duration(path)
+
+def file_durations(paths, cache_file=DURATION_CACHE_FILE, workers=None, chunksize=8):
+    # duration of every file, scanned only when not cached with the same size and mtime
+    cache = {}
+    if os.path.exists(cache_file):
+        with open(cache_file) as f:
+            cache = json.load(f)
+    stats = [os.stat(path) for path in paths]
+    stale = [path for path, stat in zip(paths, stats)
+             if cache.get(path, [None, None])[:2] != [stat.st_size, stat.st_mtime_ns]]
+    print('{} / {} files to scan'.format(len(stale), len(paths)))
+    if stale:
+        for path, duration in zip(stale, process_map(file_duration, stale, workers=workers, chunksize=chunksize)):
+            stat = os.stat(path)
+            cache[path] = [stat.st_size, stat.st_mtime_ns, duration]
+        save_json(cache_file, cache)
+    return [cache[path][2] for path in paths]
+
+def statistics_other_datasets(roots, workers=None):
+    # roots: source name -> dataset root
+    files = dict((source, source_scanners[source](root)) for source, root in roots.items())
+    paths = [path for source in roots for path, _ in files[source]]
+    durations = dict(zip(paths, file_durations(paths, workers=workers)))
+
+    for source in roots:
+        source_durations = np.array([durations[path] for path, _ in files[source]])
+        has_audio = np.array([audio for _, audio in files[source]], dtype=bool)
+        print('{} dataset:'.format(source))
+        print(' n:', len(source_durations), 'duration:', source_durations.sum() / 3600)
+        if source == 'ASAP':
+            print(' n_audio:', has_audio.sum(), 'duration_audio:', source_durations[has_audio].sum() / 3600)
 
 if __name__ == '__main__':
 
-    # print_statistics()
-    statistics_other_datasets()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dimensions',
+                        type=str,
+                        nargs='+',
+                        default=['subset', 'source', 'split'],
+                        help='Dimensions of the statistics cube, metadata columns such as composer, or piano')
+    parser.add_argument('--other_datasets',
+                        action='store_true',
+                        help='Statistics of the original MAPS, A-MAPS and ASAP datasets instead')
+    parser.add_argument('--MAPS',
+                        type=str,
+                        default='/import/c4dm-01/MAPS_original',
+                        help='Path to the MAPS dataset')
+    parser.add_argument('--A_MAPS',
+                        type=str,
+                        default='/import/c4dm-datasets/A2S_transcription/working/A-MAPS_1.1/midi',
+                        help='Path to the A_MAPS midi files')
+    parser.add_argument('--ASAP',
+                        type=str,
+                        default='/import/c4dm-datasets/ASAP_dataset/asap-dataset-1.1',
+                        help='Path to the ASAP dataset')
+    parser.add_argument('--sources',
+                        type=str,
+                        nargs='+',
+                        choices=list(source_scanners.keys()),
+                        default=list(source_scanners.keys()),
+                        help='Datasets of --other_datasets')
+    parser.add_argument('--workers',
+                        type=int,
+                        default=None,
+                        help='Number of worker processes (default: all cores)')
+    args = parser.parse_args()
+
+    if args.other_datasets:
+        statistics_other_datasets(dict((source, getattr(args, source)) for source in args.sources), workers=args.workers)
+    else:
+        print_statistics(args.dimensions, workers=args.workers)
\ No newline at end of file
@@ -0,0 +1,149 @@
+import os
+import argparse
+import functools
+import pandas as pd
+import numpy as np
+
+from utilities import metadata_map
+from midi_cache import load_midi
+from metadata_store import load_metadata
+from pianoroll_store import compute_pianoroll
+from quantization import quantize_notes, with_notes
+from polyphony_constraint import polyphony_keep_mask, tie_breaks
+from evaluation import f_measure_intervals
+
+## Grid sweeps of the resolution / polyphony upper-limit studies of tests.py
+## (validate_resolution, validate_upper_performance). Every MIDI score is
+## parsed once and all grid points are evaluated from its note arrays: the
+## quantized notes are shared by all polyphony levels, the original piano
+## rolls by all resolutions. poly_level 0 means no polyphony limit, i.e. the
+## resolution study.
+##
+##   python sweep.py --resolutions 4 8 12 24 48 --poly_levels 0 4 6 8 --split test
+score_columns = ['folder', 'MIDI_score']
+evaluation_columns = ['precision', 'recall', 'f_measure', 'accuracy']
+
+def get_scores(metadata):
+    # distinct MIDI scores, with the number of performances of each
+    scores = metadata.groupby(score_columns, sort=False, observed=True).agg(
+        piece_id=('piece_id', 'first'),
+        composer=('composer', 'first'),
+        source=('source', 'first'),
+        split=('split', 'first'),
+        n_performances=('performance_id', 'size'),
+    )
+    return scores.reset_index()
+
+def evaluate_score(score, resolutions, poly_levels, pedal_thresholds, tie_break):
+    # results of all grid points on one MIDI score
+    midi = load_midi(os.path.join(score['folder'], score['MIDI_score']))
+    pianorolls_orig = dict((pedal_threshold, compute_pianoroll(midi, pedal_threshold=pedal_threshold)[0])
+                            for pedal_threshold in pedal_thresholds)
+
+    results = []
+    for resolution in resolutions:
+        notes_quan = quantize_notes(midi, midi['notes'], resolution)
+        for poly_level in poly_levels:
+            notes = notes_quan if poly_level == 0 else notes_quan[polyphony_keep_mask(notes_quan, poly_level, tie_break)]
+            midi_tran = with_notes(midi, notes)
+            for pedal_threshold in pedal_thresholds:
+                pianoroll_tran, _ = compute_pianoroll(midi_tran, pedal_threshold=pedal_threshold)
+                evaluation = f_measure_intervals(pianoroll_tran, pianorolls_orig[pedal_threshold])
+                results.append([resolution, poly_level, pedal_threshold] + [float(e) for e in evaluation])
+    return results
+
+def run_sweep(metadata, resolutions, poly_levels, pedal_thresholds=(128,), tie_break='lowest_pitch', workers=None, chunksize=1):
+    # tidy table with one row per MIDI score and grid point
+    scores = get_scores(metadata)
+    print('\nSweep {} scores x {} grid points.'.format(len(scores), len(resolutions) * len(poly_levels) * len(pedal_thresholds)))
+
+    evaluate = functools.partial(evaluate_score,
+                                resolutions=resolutions,
+                                poly_levels=poly_levels,
+                                pedal_thresholds=pedal_thresholds,
+                                tie_break=tie_break)
+    results_list = metadata_map(evaluate, scores, workers=workers, chunksize=chunksize)
+
+    results = []
+    for score, score_results in zip(scores.to_dict('records'), results_list):
+        for result in score_results:
+            results.append([score[column] for column in scores.columns] + result)
+    grid_columns = ['resolution', 'poly_level', 'pedal_threshold']
+    return pd.DataFrame(results, columns=list(scores.columns) + grid_columns + evaluation_columns)
+
+def summarize_sweep(results, by=('resolution', 'poly_level', 'pedal_threshold')):
+    # mean evaluation of every grid point over the performances (scores weighted by their number of performances),
+    # the same averages as the validators in tests.py
+    summary = []
+    for key, group in results.groupby(list(by), sort=True, observed=True):
+        means = [np.average(group[column], weights=group['n_performances']) for column in evaluation_columns]
+        summary.append(list(key) + [len(group), group['n_performances'].sum()] + means)
+    return pd.DataFrame(summary, columns=list(by) + ['n_scores', 'n_performances'] + evaluation_columns)
+
+def save_table(table, filename):
+    table.to_csv(filename + '.csv', index=False)
+    try:
+        table.to_parquet(filename + '.parquet', index=False)
+    except ImportError:
+        pass  # pyarrow not installed, CSV only
+    print('Written', filename, len(table), 'rows')
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--resolutions',
+                        type=int,
+                        nargs='+',
+                        default=[4, 8, 12, 16, 24, 48],
+                        help='Quantization resolutions (ticks per beat)')
+    parser.add_argument('--poly_levels',
+                        type=int,
+                        nargs='+',
+                        default=[0, 4, 6, 8, 10],
+                        help='Maximum polyphony levels, 0 for no limit')
+    parser.add_argument('--pedal_thresholds',
+                        type=int,
+                        nargs='+',
+                        default=[128],
+                        help='Sustain pedal thresholds of the piano rolls (128 ignores the pedal)')
+    parser.add_argument('--tie_break',
+                        type=str,
+                        choices=list(tie_breaks.keys()),
+                        default='lowest_pitch',
+                        help='Order of notes starting together under the polyphony limit')
+    parser.add_argument('--split',
+                        type=str,
+                        nargs='+',
+                        default=None,
+                        help='Only performances from these splits')
+    parser.add_argument('--source',
+                        type=str,
+                        nargs='+',
+                        default=None,
+                        help='Only performances from these sources')
+    parser.add_argument('--output',
+                        type=str,
+                        default='sweep',
+                        help='Output tables: <output>_results.csv/.parquet per score, <output>_summary.csv/.parquet per grid point')
+    parser.add_argument('--workers',
+                        type=int,
+                        default=None,
+                        help='Number of worker processes (default: all cores)')
+    parser.add_argument('--chunksize',
+                        type=int,
+                        default=1,
+                        help='Number of scores sent to a worker process at a time')
+    args = parser.parse_args()
+
+    metadata = pd.concat([load_metadata('metadata_R.csv', split=args.split, source=args.source),
+                          load_metadata('metadata_S.csv', split=args.split, source=args.source)], ignore_index=True)
+    results = run_sweep(metadata, args.resolutions, args.poly_levels, args.pedal_thresholds, args.tie_break,
+                        workers=args.workers, chunksize=args.chunksize)
+    summary = summarize_sweep(results)
+    save_table(results, args.output + '_results')
+    save_table(summary, args.output + '_summary')
+
+    print('Resolution\tPoly\tPedal\tPrecision\tRecall\tF-measure\tAccuracy')
+    for row in summary.to_dict('records'):
+        print('{}\t\t{}\t{}\t{:.2f}\t\t{:.2f}\t{:.2f}\t\t{:.2f}'.format(row['resolution'], row['poly_level'], row['pedal_threshold'],
+                row['precision'], row['recall'], row['f_measure'], row['accuracy']))
@@ -1,78 +1,289 @@
 import os
 import argparse
-import pandas as pd
-import time
-import pretty_midi as pm
+import functools
+import shutil
 import subprocess
+import pandas as pd
+import numpy as np
+
+from utilities import load_path, mkdir, metadata_map, process_map, process_imap, atomic_write
+from midi_cache import load_midi
+from midi_scan import scan_midi
+from midi_writer import encode_track, write_midi, meta_event, note_events, program_change_events, ticks_at_tempo
+from materialize import materialize_files, verify_modes
+from audio_io import write_wav_blocks
+from build_manifest import load_manifest, save_manifest, stage_version, stale_rows, record_rows
+
+BATCH_RESOLUTION = 220  # PrettyMIDI defaults
+BATCH_TEMPO = 120.
+
+def write_batch_midi(midi, filename):
+    # all notes on one piano track, the same file as writing them into a new PrettyMIDI object
+    tick_scale = 60.0 / (BATCH_TEMPO * BATCH_RESOLUTION)
+    timing_track = encode_track(meta_events=[
+        meta_event(0, 'time_signature', numerator=4, denominator=4),
+        meta_event(0, 'set_tempo', tempo=int(6e7 / (60. / (tick_scale * BATCH_RESOLUTION)))),
+    ])
+    notes = midi['notes']
+    piano_events = np.concatenate([
+        program_change_events([0], [0]),
+        note_events(ticks_at_tempo(notes['start'], BATCH_RESOLUTION, BATCH_TEMPO),
+                    ticks_at_tempo(notes['end'], BATCH_RESOLUTION, BATCH_TEMPO),
+                    notes['pitch'],
+                    notes['velocity']),
+    ])
+    piano_track = encode_track(piano_events, [meta_event(0, 'track_name', name='Piano')])
+    write_midi(filename, [timing_track, piano_track], BATCH_RESOLUTION)
+
+## Batch preparation: every synthetic performance is rewritten under
+## batches/<piano>/ for the external renderer. Pianos are prepared one shard
+## at a time in parallel, and the batch manifest records each written file
+## (stage 'batches' of build_manifest), so an interrupted run resumes with the
+## files still missing or out of date. The files of each piano are then split
+## into render batches within a file count and audio duration budget, listed
+## in batches/batches.csv.
+BATCH_DIR = 'batches'
+BATCH_MANIFEST_FILE = os.path.join('.cache', 'batch_manifest.json')
+BATCH_MAX_FILES = 100  # per render batch
+BATCH_MAX_DURATION = 4 * 3600.  # seconds of audio per render batch
+
+def get_piano(row):
+    return row['performance_audio'][:-4].split('_Kontakt_')[1]
+
+def synthetic_rows(metadata_S):
+    # performances without an external recording, to be synthesized
+    return metadata_S.loc[metadata_S['performance_audio_external'].isna()]
 
-from utilities import load_path, mkdir
+def batch_targets(row):
+    performance_MIDI_internal = os.path.join(load_path(row['folder']), row['performance_MIDI'])
+    performance_MIDI_inbatch = os.path.join(BATCH_DIR, get_piano(row), row['performance_MIDI'])
+    return [(performance_MIDI_inbatch, [performance_MIDI_internal], True)]
 
+def prepare_batch_file(row):
+    # rewrite the midi file so it can be directly processed by reaper batch converter
+    [(performance_MIDI_inbatch, [performance_MIDI_internal], _)] = batch_targets(row)
+    mkdir(os.path.split(performance_MIDI_inbatch)[0])
+    write_batch_midi(load_midi(performance_MIDI_internal), performance_MIDI_inbatch)
 
-def prepare_batches():
+def batch_file_info(row):
+    # (audio duration, bytes) of a batch midi file
+    [(performance_MIDI_inbatch, _, _)] = batch_targets(row)
+    return scan_midi(performance_MIDI_inbatch)['end_time'], os.path.getsize(performance_MIDI_inbatch)
+
+def assign_batches(durations, max_files=BATCH_MAX_FILES, max_duration=BATCH_MAX_DURATION):
+    # batch index of every file, files taken in order until a budget is exceeded
+    # (a file longer than max_duration gets a batch of its own)
+    batches = np.zeros(len(durations), dtype=np.int64)
+    batch, n_files, duration = 0, 0, 0.
+    for i, file_duration in enumerate(durations):
+        if n_files > 0 and (n_files + 1 > max_files or duration + file_duration > max_duration):
+            batch, n_files, duration = batch + 1, 0, 0.
+        batches[i] = batch
+        n_files += 1
+        duration += file_duration
+    return batches
+
+def prepare_batches(max_files=BATCH_MAX_FILES, max_duration=BATCH_MAX_DURATION, workers=None, chunksize=8):
     print('Copy performance midis to batches...')
 
-    metadata_S = pd.read_csv('metadata_S.csv')
-    for i, row in metadata_S.iterrows():
-        print(i+1, '/', len(metadata_S), end='\r')
-
-        if type(row['performance_audio_external']) == float:
-            performance_audio = row['performance_audio']
-            piano = performance_audio[:-4].split('_Kontakt_')[1]
-
-            performance_MIDI_internal = os.path.join(load_path(row['folder']), row['performance_MIDI'])
-            performance_MIDI_inbatch = os.path.join('batches', piano, row['performance_MIDI'])
-            
-            # rewrite midi files so they can be directly processed by reaper batch converter.
-            if not os.path.exists(performance_MIDI_inbatch):
-                mkdir(os.path.split(performance_MIDI_inbatch)[0])
-
-                midi_data_internal = pm.PrettyMIDI(performance_MIDI_internal)
-                midi_data_inbatch = pm.PrettyMIDI()
-                midi_data_inbatch.instruments.append(pm.Instrument(program=0, name='Piano'))
-
-                for inst in midi_data_internal.instruments:
-                    for note in inst.notes:
-                        note_inbatch = pm.Note(velocity=note.velocity,
-                                                pitch=note.pitch,
-                                                start=note.start,
-                                                end=note.end)
-                        midi_data_inbatch.instruments[0].notes.append(note_inbatch)
-                
-                midi_data_inbatch.write(performance_MIDI_inbatch)
-                time.sleep(0.02)
+    metadata = synthetic_rows(pd.read_csv('metadata_S.csv')).copy()
+    metadata['piano'] = [get_piano(row) for row in metadata.to_dict('records')]
+    manifest = load_manifest(BATCH_MANIFEST_FILE)
+    version = stage_version(1, [prepare_batch_file, write_batch_midi, encode_track, note_events])
+
+    stale = stale_rows(manifest, metadata, batch_targets, 'batches', version)
+    metadata_stale = metadata.loc[stale].sort_values('piano', kind='stable')
+    for piano, metadata_piano in metadata.groupby('piano', sort=True):
+        print('{}: {} / {} files to write'.format(piano, int((metadata_stale['piano'] == piano).sum()), len(metadata_piano)))
+
+    # all stale files go through one pool, sharded by piano: a piano is recorded in the manifest as
+    # soon as its last file is written, files of an unfinished piano are written again after an interruption
+    rows = metadata_stale.to_dict('records')
+    remaining = metadata_stale['piano'].value_counts().to_dict()
+    for i, (row, _) in enumerate(zip(rows, process_imap(prepare_batch_file, rows, workers=workers, chunksize=chunksize))):
+        print(i+1, '/', len(rows), end='\r')
+        remaining[row['piano']] -= 1
+        if remaining[row['piano']] == 0:
+            record_rows(manifest, metadata_stale.loc[metadata_stale['piano'] == row['piano']], batch_targets, 'batches', version)
+            save_manifest(manifest, BATCH_MANIFEST_FILE)
     print()
 
-def distribute_audio_files():
-    print('Distribute synthesized audio files into dataset...')
+    # render batches within the budgets, per piano in metadata order
+    print('\nSplit into render batches...')
+    infos = metadata_map(batch_file_info, metadata, workers=workers, chunksize=chunksize)
+    metadata['duration'] = [duration for duration, _ in infos]
+    metadata['bytes'] = [size for _, size in infos]
+    batches = []
+    for piano, metadata_piano in metadata.groupby('piano', sort=True):
+        metadata_piano = metadata_piano[['piano', 'performance_MIDI', 'duration', 'bytes']].copy()
+        metadata_piano.insert(1, 'batch', assign_batches(metadata_piano['duration'].values, max_files, max_duration))
+        batches.append(metadata_piano)
+    batches = pd.concat(batches, ignore_index=True)
+    batches.to_csv(os.path.join(BATCH_DIR, 'batches.csv'), index=False)
 
-    metadata_S = pd.read_csv('metadata_S.csv')
-    for i, row in metadata_S.iterrows():
-        print(i+1, '/', len(metadata_S), end='\r')
+    summary = batches.groupby(['piano', 'batch']).agg(files=('performance_MIDI', 'size'), duration=('duration', 'sum'))
+    for row in summary.reset_index().to_dict('records'):
+        print('{}\tbatch {}\t{} files\t{:.1f} h'.format(row['piano'], row['batch'], row['files'], row['duration'] / 3600))
+    print('Written', os.path.join(BATCH_DIR, 'batches.csv'), len(summary), 'batches')
+    return batches
 
-        if type(row['performance_audio_external']) == float:
-            performance_audio = row['performance_audio']
-            piano = performance_audio[:-4].split('_Kontakt_')[1]
+## Local rendering of the batch midi files to batches/<piano>/*.wav, instead of
+## the REAPER/Kontakt round trip between --step 1 and --step 2. A renderer is
+## a function render(midi_file, wav_file, sample_rate, piano, **options):
+##   additive    built-in additive piano-like synth (numpy only), rendered and
+##               written block by block
+##   fluidsynth  the fluidsynth command line player with a soundfont (--soundfont)
+## Files are rendered in parallel into a temporary file, then moved in place,
+## so existing wav files are complete and are skipped by a resumed run.
+RENDER_SAMPLE_RATE = 44100
+RENDER_BLOCK_SECONDS = 10.
+ADDITIVE_PARTIALS = 8
+ADDITIVE_RELEASE = 0.1  # seconds, decay time constant after the note off
+ADDITIVE_TAIL = 5 * ADDITIVE_RELEASE  # rendered length after the note off
 
-            performance_audio_internal = os.path.join('audio_files', load_path(row['folder']), performance_audio)
-            performance_audio_inbatch = os.path.join('batches', piano, row['performance_MIDI'][:-4]+'.wav')
+def additive_blocks(notes, sample_rate, brightness, block_seconds=RENDER_BLOCK_SECONDS):
+    # stereo float blocks of the notes: decaying harmonic partials, panned by pitch
+    order = np.argsort(notes['start'], kind='stable')
+    starts = np.round(notes['start'][order] * sample_rate).astype(np.int64)
+    ends = np.round(notes['end'][order] * sample_rate).astype(np.int64)
+    tails = ends + int(ADDITIVE_TAIL * sample_rate)
+    pitches = notes['pitch'][order].astype(np.float64)
+    gains = (notes['velocity'][order] / 127.) ** 2 * 0.1
+    frequencies = 440. * 2 ** ((pitches - 69) / 12)
+    decays = 3. * 2 ** (-(pitches - 60) / 24)  # seconds, low notes ring longer
+    pans = np.clip((pitches - 21) / 87, 0, 1) * np.pi / 2
+    partials = np.arange(1, ADDITIVE_PARTIALS + 1)
+    partial_gains = brightness ** (partials - 1) / partials
 
-            if not os.path.exists(performance_audio_internal):
-                mkdir(os.path.split(performance_audio_internal)[0])
-                subprocess.check_output(['mv', performance_audio_inbatch, performance_audio_internal])
-                time.sleep(0.02)
-    print()
+    n_samples = int(tails.max()) if len(notes) else 0
+    block_samples = int(block_seconds * sample_rate)
+    for block_start in range(0, n_samples, block_samples):
+        block_end = min(block_start + block_samples, n_samples)
+        block = np.zeros((block_end - block_start, 2), dtype=np.float64)
+        # notes sounding in the block: started before its end, tail not over before its start
+        for i in np.flatnonzero(tails[:np.searchsorted(starts, block_end)] > block_start):
+            first, last = max(starts[i], block_start), min(tails[i], block_end)
+            t = np.arange(first - starts[i], last - starts[i]) / sample_rate
+            envelope = np.minimum(t / 0.005, 1.) * np.exp(-t / decays[i])  # 5 ms attack
+            released = t > (ends[i] - starts[i]) / sample_rate
+            envelope[released] *= np.exp(-(t[released] - (ends[i] - starts[i]) / sample_rate) / ADDITIVE_RELEASE)
+            audible = partials * frequencies[i] < sample_rate / 2
+            wave = np.sin(2 * np.pi * frequencies[i] * np.outer(t, partials[audible])) @ partial_gains[audible]
+            wave *= envelope * gains[i]
+            block[first-block_start:last-block_start, 0] += wave * np.cos(pans[i])
+            block[first-block_start:last-block_start, 1] += wave * np.sin(pans[i])
+        yield block
+
+def render_additive(midi_file, wav_file, sample_rate, piano):
+    # brighter partials for the hard piano fonts
+    brightness = 0.6 if piano.endswith('_hard') else 0.4
+    blocks = additive_blocks(load_midi(midi_file)['notes'], sample_rate, brightness)
+    write_wav_blocks(wav_file, blocks, sample_rate, channels=2)
+
+def render_fluidsynth(midi_file, wav_file, sample_rate, piano, soundfont=None, gain=0.5):
+    if soundfont is None or shutil.which('fluidsynth') is None:
+        raise ValueError('The fluidsynth renderer needs the fluidsynth program and a soundfont (--soundfont)')
+    subprocess.run(['fluidsynth', '-ni', '-q', '-F', wav_file, '-T', 'wav', '-r', str(sample_rate), '-g', str(gain),
+                    soundfont, midi_file], check=True, stdout=subprocess.DEVNULL)
+
+renderers = {
+    'additive': render_additive,
+    'fluidsynth': render_fluidsynth,
+}
+
+def render_batch_file(item, renderer, sample_rate, options):
+    midi_file, wav_file, piano = item
+    atomic_write(wav_file, lambda tmp: renderers[renderer](midi_file, tmp, sample_rate, piano, **options), suffix='.wav')
+
+def render_batches(renderer='additive', pianos=None, sample_rate=RENDER_SAMPLE_RATE, overwrite=False, workers=None, chunksize=1, **options):
+    print('Render batches with the {} renderer...'.format(renderer))
+
+    items = []
+    for row in synthetic_rows(pd.read_csv('metadata_S.csv')).to_dict('records'):
+        piano = get_piano(row)
+        performance_MIDI_inbatch = os.path.join(BATCH_DIR, piano, row['performance_MIDI'])
+        performance_audio_inbatch = performance_MIDI_inbatch[:-4] + '.wav'
+        if (pianos is None or piano in pianos) and (overwrite or not os.path.exists(performance_audio_inbatch)):
+            items.append((performance_MIDI_inbatch, performance_audio_inbatch, piano))
+    print(len(items), 'files to render')
+
+    render = functools.partial(render_batch_file, renderer=renderer, sample_rate=sample_rate, options=options)
+    process_map(render, items, workers=workers, chunksize=chunksize)
+
+def distribute_audio_files(verify='size', workers=16):
+    print('Distribute synthesized audio files into dataset...')
+
+    pairs = []
+    for row in synthetic_rows(pd.read_csv('metadata_S.csv')).to_dict('records'):
+        performance_audio_internal = os.path.join('audio_files', load_path(row['folder']), row['performance_audio'])
+        performance_audio_inbatch = os.path.join(BATCH_DIR, get_piano(row), row['performance_MIDI'][:-4]+'.wav')
+        pairs.append((performance_audio_inbatch, performance_audio_internal))
+
+    materialize_files(pairs, mode='move', verify=verify, workers=workers)
 
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--step',
                         type=int,
-                        help='Select step. 1: prepare batches, 2: distribute audio files')
+                        help='Select step. 1: prepare batches, 2: distribute audio files, 3: render batches locally and distribute audio files')
+    parser.add_argument('--verify',
+                        type=str,
+                        choices=verify_modes,
+                        default='size',
+                        help='Check moved audio files by size or checksum')
+    parser.add_argument('--io_workers',
+                        type=int,
+                        default=16,
+                        help='Number of concurrent file moves')
+    parser.add_argument('--batch_max_files',
+                        type=int,
+                        default=BATCH_MAX_FILES,
+                        help='Maximum number of files per render batch')
+    parser.add_argument('--batch_max_hours',
+                        type=float,
+                        default=BATCH_MAX_DURATION / 3600,
+                        help='Maximum hours of audio per render batch')
+    parser.add_argument('--workers',
+                        type=int,
+                        default=None,
+                        help='Number of worker processes (default: all cores)')
+    parser.add_argument('--chunksize',
+                        type=int,
+                        default=8,
+                        help='Number of files sent to a worker process at a time')
+    parser.add_argument('--renderer',
+                        type=str,
+                        choices=list(renderers.keys()),
+                        default='additive',
+                        help='Local renderer of step 3')
+    parser.add_argument('--soundfont',
+                        type=str,
+                        default=None,
+                        help='Soundfont file of the fluidsynth renderer')
+    parser.add_argument('--pianos',
+                        type=str,
+                        nargs='+',
+                        default=None,
+                        help='Only render the batches of these pianos, e.g. Giant_hard')
+    parser.add_argument('--sample_rate',
+                        type=int,
+                        default=RENDER_SAMPLE_RATE,
+                        help='Sample rate of the rendered audio')
+    parser.add_argument('--overwrite',
+                        action='store_true',
+                        help='Render again the files already rendered')
     args = parser.parse_args()
     
     if args.step == 1:
-        prepare_batches()
+        prepare_batches(max_files=args.batch_max_files, max_duration=args.batch_max_hours * 3600,
+                        workers=args.workers, chunksize=args.chunksize)
     elif args.step == 2:
-        distribute_audio_files()
+        distribute_audio_files(verify=args.verify, workers=args.io_workers)
+    elif args.step == 3:
+        options = {'soundfont': args.soundfont} if args.renderer == 'fluidsynth' else {}
+        render_batches(args.renderer, args.pianos, args.sample_rate, args.overwrite,
+                       workers=args.workers, chunksize=args.chunksize, **options)
+        distribute_audio_files(verify=args.verify, workers=args.io_workers)
     else:
         raise ValueError('Input Error! Check help!')
\ No newline at end of file
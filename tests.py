@@ -1,276 +1,174 @@
 import warnings
 warnings.filterwarnings('ignore')
 import os
+import sys
+import argparse
 import pandas as pd
-import pretty_midi as pm
 import numpy as np
 import matplotlib.pyplot as plt
-from collections import defaultdict
-
-
-
-def all_files_exist(metadata):
-    print('\nAll file exists?')
-    for i, row in metadata.iterrows():
-        performance_audio = os.path.join('audio_files', row['folder'], row['performance_audio'])
-        performance_MIDI = os.path.join(row['folder'], row['performance_MIDI'])
-        MIDI_score = os.path.join(row['folder'], row['MIDI_score'])
-        performance_beat_annotation = os.path.join(row['folder'], row['performance_beat_annotation'])
-        score_beat_annotation = os.path.join(row['folder'], row['score_beat_annotation'])
-
-        for f in [performance_audio, 
-                performance_MIDI,
-                MIDI_score,
-                performance_beat_annotation,
-                score_beat_annotation]:
-            if not os.path.exists(f):
-                print('Nope.', row['performance_id'])
-                return
-    print('Yes!')
-
-def MIDI_score_downbeat_annotation_matched(metadata):
-    print('\nMIDI score annotation matched?')
-
-    matched = True
-    for i, row in metadata.iterrows():
-        print(i+1, '/', len(metadata), end='\r')
-        if row['source'] == 'ASAP':
-            # raw annotation
-            score_annotation = pd.read_csv(os.path.join(row['folder'], row['score_beat_annotation']), header=None, delimiter='\t')
-
-            # beats from MIDI_score
-            MIDI_score_file = os.path.join(row['folder'], row['MIDI_score'])
-            midi_data = pm.PrettyMIDI(MIDI_score_file)
-            beats = midi_data.get_downbeats()
-            
-            for bi, brow in score_annotation.iterrows():
-                if brow[2].split(',')[0] == 'db':
-                    downbeat = brow[0]
-                    if min(abs(beats - downbeat)) > 0.01:
-                        print('\nNope.', 'performance_id:', row['performance_id'], 'source:', row['source'], 'distance:', min(abs(beats - downbeat)))
-                        matched = False
-                        break
-    if matched:
-        print('\nYes!')
-    else:
-        print('\nNope!')
-
-def MIDI_score_beat_annotations_validation(metadata):
-    print('\nCheck if MIDI score beat annotations are valid (falls exactly at beats/subbeats)')
-    valid_beats = np.array([0., 0.125, 0.25, 0.33333333333, 0.375, 0.5, 0.625, 0.66666666667, 0.75, 0.875, 1.])
-
-    count_invalid = 0
-    count_all = 0
-    invalid_performance_ids = set()
-    for i, row in metadata.iterrows():
-        print(i+1, '/', len(metadata), end='\r')
-        if row['source'] == 'ASAP':
-            # annotation
-            score_annotation = pd.read_csv(os.path.join(row['folder'], row['score_beat_annotation']), header=None, delimiter='\t')
-            
-            midi_data = pm.PrettyMIDI(os.path.join(row['folder'], row['MIDI_score']))
-            beats_in_score = [midi_data.time_to_tick(beat) / midi_data.resolution for beat in score_annotation[0]]
-            for beat_in_score in beats_in_score:
-                if np.min(np.abs(valid_beats - (beat_in_score % 1))) > 0.02:
-                    invalid_performance_ids.add(row['performance_id'])
-                    count_invalid += 1
-            count_all += len(beats_in_score)
-            print(i+1, '/', len(metadata), 'Invalid annot percentage:', count_invalid / count_all, end='\r')
-    print('\nInvalid performance_ids:')
-    print(invalid_performance_ids)
-
-def two_hand_parts(metadata):
-    print('\nTwo hand parts?')
-    count_not_two_hand = 0
-    for i, row in metadata.iterrows():
-        print(i+1, '/', len(metadata), 'Not two-hand count:', count_not_two_hand, end='\r')
-        MIDI_score_file = os.path.join(row['folder'], row['MIDI_score'])
-        midi_data = pm.PrettyMIDI(MIDI_score_file)
-
-        if len(midi_data.instruments) != 2:
-            print('\nNope.', row['performance_id'], 'source:', row['source'], 'split:', row['split'], 'hand parts:', len(midi_data.instruments))
-            count_not_two_hand += 1
-
-    if count_not_two_hand == 0:
-        print('\nYes!')
-
-def check_polyphony(metadata):
-    print('\nCheck polyphony level.')
-
-    polyphonys_with_pedal_list = []
-    polyphonys_no_pedal_list = []
-    for i, row in metadata.iterrows():
-        print(i+1, '/', len(metadata), end='\r')
-        midi_data = pm.PrettyMIDI(os.path.join(row['folder'], row['performance_MIDI']))
-        pianoroll_with_pedal = midi_data.get_piano_roll(pedal_threshold=64) > 0
-        pianoroll_no_pedal = midi_data.get_piano_roll(pedal_threshold=128) > 0
-
-        polyphonys_with_pedal = pianoroll_with_pedal.sum(axis=0)
-        polyphonys_no_pedal = pianoroll_no_pedal.sum(axis=0)
-
-        polyphonys_with_pedal_list.append(polyphonys_with_pedal)
-        polyphonys_no_pedal_list.append(polyphonys_no_pedal)
-
-    print()
-    all_polyphonys_with_pedal = np.concatenate(polyphonys_with_pedal_list)
-    all_polyphonys_no_pedal = np.concatenate(polyphonys_no_pedal_list)
-
-    print('Stat', '\t\t', 'Max', '\t', 'Mean', '\t', 'Medium')
-    print('with pedal', '\t', np.max(all_polyphonys_with_pedal), '\t', np.mean(all_polyphonys_with_pedal) // 0.01 / 100, '\t', np.median(all_polyphonys_with_pedal))
-    print('no pedal', '\t', np.max(all_polyphonys_no_pedal), '\t', np.mean(all_polyphonys_no_pedal) // 0.01 / 100, '\t', np.median(all_polyphonys_no_pedal))
-
-    fig, (ax1, ax2) = plt.subplots(2, 1)
-    ax1.hist(all_polyphonys_with_pedal, bins=50)
-    ax1.set_title('polyphony levels with pedal')
-    ax2.hist(all_polyphonys_no_pedal, bins=50)
-    ax2.set_title('polyphony levels without pedal')
-    fig.savefig('check_polyphony.pdf')
 
-def validate_resolution(metadata, resolution=12):
-    print('\nValidate resolution {}.'.format(resolution))
-
-    evals = []
-    for ri, row in metadata.iterrows():
-        print(ri+1, '/', len(metadata), end='\r')
-        midi_data = pm.PrettyMIDI(os.path.join(row['folder'], row['MIDI_score']))
-        pianoroll_orig = midi_data.get_piano_roll(pedal_threshold=128) > 0  # original pianoroll without pedal
-
-        # quantize tick by resolution
-        for inst in midi_data.instruments:
-            short_notes_indexes = []
-            for i, note in enumerate(inst.notes):
-                
-                note.start = midi_data.tick_to_time(quantize_tick(midi_data.time_to_tick(note.start), midi_data.resolution, resolution))
-                note.end = midi_data.tick_to_time(quantize_tick(midi_data.time_to_tick(note.end), midi_data.resolution, resolution))
-                if note.start >= note.end:
-                    short_notes_indexes.append(i)
-            
-            for i in short_notes_indexes[::-1]:
-                del inst.notes[i]
-        pianoroll_quan = midi_data.get_piano_roll(pedal_threshold=128) > 0  # quantized pianoroll without pedal
-
-        length = max(pianoroll_orig.shape[1], pianoroll_quan.shape[1])
-        pianoroll_orig = np.concatenate([pianoroll_orig, np.zeros((128, length-pianoroll_orig.shape[1]), dtype=bool)], axis=1)
-        pianoroll_quan = np.concatenate([pianoroll_quan, np.zeros((128, length-pianoroll_quan.shape[1]), dtype=bool)], axis=1)
-        p, r, f, acc = f_measure_pianoroll(pianoroll_quan, pianoroll_orig)
-        evals.append((p, r, f, acc))
-
-    evals = list(zip(*evals))
-    print('\nPrecision\tRecall\tF-measure\tAccuracy')
-    print('{:.2f}\t\t{:.2f}\t{:.2f}\t\t{:.2f}'.format(np.mean(evals[0]), np.mean(evals[1]), np.mean(evals[2]), np.mean(evals[3])))
-
-def check_beat_annotation_sorted(metadata):
-    print('\nCheck is beat annotation sorted?')
-
-    all_sorted = True
-    for i, row in metadata.iterrows():
-        print(i+1, '/', len(metadata), end='\r')
-
-        beat_annotation_perfm = pd.read_csv(os.path.join(row['folder'], row['performance_beat_annotation']), header=None, sep='\t')
-        beat_annotation_score = pd.read_csv(os.path.join(row['folder'], row['score_beat_annotation']), header=None, sep='\t')
-
-        beats_perfm = np.array(beat_annotation_perfm[0])
-        beats_score = np.array(beat_annotation_score[0])
-
-        if min(beats_perfm[1:] - beats_perfm[:-1]) < 0:
-            print('\n performance beats not sorted! performance_id: {}, aligned: {}'.format(row['performance_id'], row['aligned']))
-            all_sorted = False
-        if min(beats_score[1:] - beats_score[:-1]) < 0:
-            print('\n score beats not sorted! performance_id: {}, aligned: {}'.format(row['performance_id'], row['aligned']))
-            all_sorted = False
-
-    if all_sorted:
-        print('\nYes!')
-    else:
-        print('\nNope!')
-
-def validate_upper_performance(metadata, resolution=24, poly_level=8):
-    print('\nValidate performance upper limit with resolution 24, maximum polyphony 8.')
-
-    evals = []
-    for ri, row in metadata.iterrows():
-        print(ri+1, '/', len(metadata), end='\r')
-        midi_data = pm.PrettyMIDI(os.path.join(row['folder'], row['MIDI_score']))
-        pianoroll_orig = midi_data.get_piano_roll(pedal_threshold=128) > 0  # original pianoroll without pedal
-
-        # quantize tick by resolution
-        for inst in midi_data.instruments:
-            short_notes_indexes = []
-            for i, note in enumerate(inst.notes):
-                
-                note.start = midi_data.tick_to_time(quantize_tick(midi_data.time_to_tick(note.start), midi_data.resolution, resolution))
-                note.end = midi_data.tick_to_time(quantize_tick(midi_data.time_to_tick(note.end), midi_data.resolution, resolution))
-                if note.start >= note.end:
-                    short_notes_indexes.append(i)
-            
-            for i in short_notes_indexes[::-1]:
-                del inst.notes[i]
-
-        # remove polyphony > 8
-        all_notes = []
-        for ii, inst in enumerate(midi_data.instruments):
-            for ni, note in enumerate(inst.notes):
-                all_notes.append((ii, ni, note))
-        all_notes.sort(key=lambda x: x[2].start * 100000 + x[2].pitch / 100)
-        notes_cur = []
-        inotes_del = []
-        for ii, ni, note in all_notes:
-            for n in notes_cur:
-                if n.end <= note.start:
-                    notes_cur.remove(n)
-            if len(notes_cur) == poly_level:
-                inotes_del.append((ii, ni))
-            else:
-                notes_cur.append(note)
-        inotes_del.sort(key=lambda x: x[1], reverse=True)
-        for ii, ni in inotes_del:
-            del midi_data.instruments[ii].notes[ni]
-        
-        # updated pianoroll
-        pianoroll_tran = midi_data.get_piano_roll(pedal_threshold=128) > 0  # updated pianoroll without pedal
-
-        length = max(pianoroll_orig.shape[1], pianoroll_tran.shape[1])
-        pianoroll_orig = np.concatenate([pianoroll_orig, np.zeros((128, length-pianoroll_orig.shape[1]), dtype=bool)], axis=1)
-        pianoroll_tran = np.concatenate([pianoroll_tran, np.zeros((128, length-pianoroll_tran.shape[1]), dtype=bool)], axis=1)
-        p, r, f, acc = f_measure_pianoroll(pianoroll_tran, pianoroll_orig)
-        evals.append((p, r, f, acc))
-
-    evals = list(zip(*evals))
-    print('\nPrecision\tRecall\tF-measure\tAccuracy')
-    print('{:.2f}\t\t{:.2f}\t{:.2f}\t\t{:.2f}'.format(np.mean(evals[0]), np.mean(evals[1]), np.mean(evals[2]), np.mean(evals[3])))
-
-def quantize_tick(tick, resolution_large, resolution_small):
-    return round(tick // (resolution_large / resolution_small) * (resolution_large / resolution_small))
-
-def f_measure_pianoroll(output, target):
-    output = output.astype(bool)
-    target = target.astype(bool)
-
-    TP = np.logical_and(output == True, target == True).sum()
-    FP = np.logical_and(output == True, target == False).sum()
-    FN = np.logical_and(output == False, target == True).sum()
-
-    p = TP / (TP + FP + np.finfo(float).eps)
-    r = TP / (TP + FN + np.finfo(float).eps)
-    f = 2 * p * r / (p + r + np.finfo(float).eps)
-    acc = TP / (TP + FP + FN + np.finfo(float).eps)
-    
-    return p, r, f, acc
+from beat_alignment import align_annotation
+from pianoroll_store import compute_pianoroll, polyphony_histogram
+from evaluation import f_measure_intervals
+from quantization import quantize_notes, with_notes
+from polyphony_constraint import polyphony_keep_mask
+from validation import checks, register_check, run_checks, write_report, print_summary, annotation_file
+
+## Dataset checks, run by the validation engine: every check gets the
+## metadata row and the shared parsed files of a performance and returns
+## (passed, value), see validation.py.
+VALIDATION_RESOLUTION = 24
+VALIDATION_POLY_LEVEL = 8
+
+def mean_evaluation(findings):
+    evals = list(zip(*findings['value']))
+    return dict(zip(['precision', 'recall', 'f_measure', 'accuracy'], [float(np.mean(e)) for e in evals]))
+
+def histogram_stats(counts):
+    # exact max, mean and median of the values counted by a histogram
+    counts = np.asarray(counts)
+    cumulative = np.cumsum(counts)
+    n = cumulative[-1]
+    median = (np.searchsorted(cumulative, (n - 1) // 2, side='right') + np.searchsorted(cumulative, n // 2, side='right')) / 2
+    mean = (np.arange(len(counts)) * counts).sum() / n
+    return {'max': int(np.flatnonzero(counts)[-1]), 'mean': float(mean), 'median': float(median)}
+
+@register_check('files_exist')
+def check_files_exist(row, files):
+    # missing files of the performance
+    missing = []
+    for f in [os.path.join('audio_files', row['folder'], row['performance_audio']),
+            os.path.join(row['folder'], row['performance_MIDI']),
+            os.path.join(row['folder'], row['MIDI_score']),
+            annotation_file(row, 'performance'),
+            annotation_file(row, 'score')]:
+        if not os.path.exists(f):
+            missing.append(f)
+    return len(missing) == 0, missing
+
+@register_check('downbeat_annotation_matched')
+def check_downbeat_annotation_matched(row, files):
+    # distance of the first annotated downbeat not matched in the MIDI score, None if all matched
+    if row['source'] != 'ASAP':
+        return True, None
+
+    distances = align_annotation(files['score_midi'], files['score_annotation'])['downbeat_distances']
+    unmatched = distances[distances > 0.01]
+    if len(unmatched) > 0:
+        return False, float(unmatched[0])
+    return True, None
+
+def summarize_beat_annotations(findings):
+    count_invalid = sum(invalid for invalid, _ in findings['value'])
+    count_all = sum(n for _, n in findings['value'])
+    return {'invalid_annotation_percentage': count_invalid / count_all if count_all else 0.}
+
+@register_check('beat_annotations_valid', summarize_beat_annotations)
+def check_beat_annotations_valid(row, files):
+    # (invalid, all) beat annotation counts of the MIDI score, annotations should fall exactly at beats/subbeats
+    if row['source'] != 'ASAP':
+        return True, [0, 0]
+
+    phase_distances = align_annotation(files['score_midi'], files['score_annotation'])['phase_distances']
+    count_invalid = int(np.sum(phase_distances > 0.02))
+    return count_invalid == 0, [count_invalid, len(phase_distances)]
+
+@register_check('two_hand_parts')
+def check_two_hand_parts(row, files):
+    hand_parts = len(files['score_midi']['instruments'])
+    return hand_parts == 2, hand_parts
+
+def summarize_polyphony(findings):
+    # polyphony statistics from the histograms summed over all performances, and per split and source
+    if len(findings) == 0:
+        return {}
+    summary = {}
+    for key in ['with_pedal', 'no_pedal']:
+        histograms = pd.DataFrame(np.array([value[key] for value in findings['value']]).reshape(len(findings), -1))
+        counts = histograms.sum().values
+        summary[key] = histogram_stats(counts)
+        summary[key + '_counts'] = counts.tolist()
+        for column in ['split', 'source']:
+            group_counts = histograms.groupby(findings[column].values, sort=True).sum()
+            summary[key + '_by_' + column] = dict((group, histogram_stats(group_counts.loc[group].values)) for group in group_counts.index)
+
+    fig, axes = plt.subplots(2, 1)
+    for ax, key, title in zip(axes, ['with_pedal', 'no_pedal'], ['polyphony levels with pedal', 'polyphony levels without pedal']):
+        counts = np.array(summary[key + '_counts'])
+        levels = np.flatnonzero(counts)
+        ax.hist(levels, bins=50, weights=counts[levels])
+        ax.set_title(title)
+    fig.savefig('check_polyphony.pdf')
+    return summary
+
+@register_check('polyphony', summarize_polyphony)
+def check_polyphony(row, files):
+    # histograms of the polyphony levels (0 to 128) of the performance, from the piano roll store
+    return True, {
+        'with_pedal': polyphony_histogram(*files['performance_pianoroll_pedal']).tolist(),
+        'no_pedal': polyphony_histogram(*files['performance_pianoroll']).tolist(),
+    }
+
+@register_check('resolution', mean_evaluation)
+def check_resolution(row, files):
+    # evaluation of the MIDI score quantized to VALIDATION_RESOLUTION against the original, without pedal
+    midi = files['score_midi']
+    pianoroll_orig, _ = files['score_pianoroll']
+    notes = quantize_notes(midi, midi['notes'], VALIDATION_RESOLUTION)
+    pianoroll_quan, _ = compute_pianoroll(with_notes(midi, notes), pedal_threshold=128)
+    return True, [float(e) for e in f_measure_intervals(pianoroll_quan, pianoroll_orig)]
+
+@register_check('beat_annotation_sorted')
+def check_beat_annotation_sorted(row, files):
+    # (performance beats sorted, score beats sorted)
+    beats_perfm = files['performance_annotation']['times']
+    beats_score = files['score_annotation']['times']
+    perfm_sorted = bool(min(beats_perfm[1:] - beats_perfm[:-1]) >= 0)
+    score_sorted = bool(min(beats_score[1:] - beats_score[:-1]) >= 0)
+    return perfm_sorted and score_sorted, [perfm_sorted, score_sorted]
+
+@register_check('upper_performance', mean_evaluation)
+def check_upper_performance(row, files):
+    # evaluation of the MIDI score quantized to VALIDATION_RESOLUTION with at most VALIDATION_POLY_LEVEL
+    # notes at a time against the original, without pedal
+    midi = files['score_midi']
+    pianoroll_orig, _ = files['score_pianoroll']
+    notes = quantize_notes(midi, midi['notes'], VALIDATION_RESOLUTION)
+    notes = notes[polyphony_keep_mask(notes, VALIDATION_POLY_LEVEL)]
+    pianoroll_tran, _ = compute_pianoroll(with_notes(midi, notes), pedal_threshold=128)
+    return True, [float(e) for e in f_measure_intervals(pianoroll_tran, pianoroll_orig)]
 
 if __name__ == '__main__':
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checks',
+                        type=str,
+                        nargs='+',
+                        choices=list(checks.keys()),
+                        default=list(checks.keys()),
+                        help='Checks to run (default: all)')
+    parser.add_argument('--report',
+                        type=str,
+                        default='validation_report.json',
+                        help='Report file, JSON with the summary and findings or CSV (.csv) with the findings')
+    parser.add_argument('--workers',
+                        type=int,
+                        default=None,
+                        help='Number of worker processes (default: all cores)')
+    parser.add_argument('--chunksize',
+                        type=int,
+                        default=8,
+                        help='Number of performances sent to a worker process at a time')
+    args = parser.parse_args()
+
     metadata_R = pd.read_csv('metadata_R.csv')
     metadata_S = pd.read_csv('metadata_S.csv')
     metadata = pd.concat([metadata_R, metadata_S], ignore_index=True)
 
-    # all_files_exist(metadata)
-    # MIDI_score_downbeat_annotation_matched(metadata)
-    MIDI_score_beat_annotations_validation(metadata)
-    # two_hand_parts(metadata)
-    # check_polyphony(metadata)
-    # validate_resolution(metadata, resolution=24)
-    # check_beat_annotation_sorted(metadata)
-    # validate_upper_performance(metadata)
+    findings, summary = run_checks(metadata, args.checks, workers=args.workers, chunksize=args.chunksize)
+    print_summary(findings, summary)
+    write_report(findings, summary, args.report)
+    sys.exit(1 if (~findings['passed']).any() else 0)
 
 ### Output:
 
@@ -1,5 +1,9 @@
 import os
 import sys
+import json
+import hashlib
+import threading
+from concurrent.futures import ProcessPoolExecutor
 
 
 def format_path(path):
@@ -16,4 +20,74 @@ def load_path(path):
 
 def mkdir(folder):
     if not os.path.exists(folder):
-        os.makedirs(folder)
\ No newline at end of file
+        os.makedirs(folder, exist_ok=True)  # may be created concurrently by another worker
+
+def file_hash(path, block_size=1 << 20):
+    # sha1 of the file content
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def atomic_write(path, write_fn, suffix=''):
+    # write_fn(tmp) writes a temporary file next to path, which then replaces path: concurrent readers
+    # never see a half-written file and an interrupted write keeps the previous one
+    # (suffix is the extension writers like np.save append to file names without it)
+    mkdir(os.path.dirname(path) or '.')
+    tmp = '{}.{}.{}.tmp{}'.format(path, os.getpid(), threading.get_ident(), suffix)
+    try:
+        write_fn(tmp)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def save_json(path, data):
+    def write(tmp):
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+    atomic_write(path, write)
+
+## shared process pool for the per-performance loops
+_executor = None
+_executor_workers = None
+
+def get_executor(workers=None):
+    # one pool per worker count, reused by every stage of a run
+    global _executor, _executor_workers
+    if _executor is None or workers != _executor_workers:
+        shutdown_executor()
+        _executor = ProcessPoolExecutor(max_workers=workers)
+        _executor_workers = workers
+    return _executor
+
+def shutdown_executor():
+    global _executor, _executor_workers
+    if _executor is not None:
+        _executor.shutdown()
+    _executor, _executor_workers = None, None
+
+def process_imap(func, items, workers=None, chunksize=1):
+    # lazy process_map: iterator over the results in the order of items, each available as soon as
+    # it and the ones before it are done
+    if workers == 1 or len(items) <= 1:
+        return map(func, items)
+    return get_executor(workers).map(func, items, chunksize=chunksize)
+
+def process_map(func, items, workers=None, chunksize=1, verbose=True):
+    # map func over items across processes, results are returned in the order of items
+    # workers=None uses all cores, workers=1 runs in the current process
+    items = list(items)
+    results = []
+    for i, result in enumerate(process_imap(func, items, workers=workers, chunksize=chunksize)):
+        if verbose:
+            print(i+1, '/', len(items), end='\r')
+        results.append(result)
+    if verbose:
+        print()
+    return results
+
+def metadata_map(func, metadata, workers=None, chunksize=1, verbose=True):
+    # apply func(row) to every row of the metadata, row order is kept
+    return process_map(func, metadata.to_dict('records'), workers=workers, chunksize=chunksize, verbose=verbose)
@@ -0,0 +1,125 @@
+import os
+import json
+import functools
+import pandas as pd
+import numpy as np
+
+from utilities import metadata_map
+from annotation_codec import read_annotation
+from midi_cache import load_midi
+from pianoroll_store import load_pianoroll
+
+## Validation engine of tests.py. Checks are registered with register_check
+## and run together in one pass over the performances, in worker processes:
+## every file of a performance is parsed once, on first use, and shared by all
+## the checks of that performance.
+##
+##   @register_check('two_hand_parts')
+##   def check_two_hand_parts(row, files):
+##       n = len(files['score_midi']['instruments'])
+##       return n == 2, n    # (passed, JSON serializable value)
+##
+## A check may also register summarize(findings) -> dict, over the findings
+## of all performances (performance_id, source, split, passed, value), for
+## checks that are measurements rather than pass/fail.
+checks = {}  # name -> (check, summarize)
+
+def register_check(name, summarize=None):
+    def register(check):
+        checks[name] = (check, summarize)
+        return check
+    return register
+
+required_columns = ['performance_id', 'source', 'split', 'folder', 'performance_audio', 'performance_MIDI', 'MIDI_score']
+# beat annotation columns, by either name (the released metadata files use the second one, see acpas_index)
+annotation_columns = {
+    'performance': ['performance_beat_annotation', 'performance_annotation'],
+    'score': ['score_beat_annotation', 'score_annotation'],
+}
+
+def check_columns(metadata):
+    missing = [column for column in required_columns if column not in metadata.columns]
+    missing += [' or '.join(columns) for columns in annotation_columns.values() if not any(c in metadata.columns for c in columns)]
+    if missing:
+        raise ValueError('Metadata columns missing: {}'.format(', '.join(missing)))
+
+def annotation_file(row, kind):
+    # path of the performance or score beat annotation of a performance
+    column = [c for c in annotation_columns[kind] if c in row][0]
+    return os.path.join(row['folder'], row[column])
+
+file_loaders = {
+    'score_midi': lambda row: load_midi(os.path.join(row['folder'], row['MIDI_score'])),
+    'performance_midi': lambda row: load_midi(os.path.join(row['folder'], row['performance_MIDI'])),
+    'score_annotation': lambda row: read_annotation(annotation_file(row, 'score')),
+    'performance_annotation': lambda row: read_annotation(annotation_file(row, 'performance')),
+    'score_pianoroll': lambda row: load_pianoroll(os.path.join(row['folder'], row['MIDI_score']), pedal_threshold=128),
+    'performance_pianoroll_pedal': lambda row: load_pianoroll(os.path.join(row['folder'], row['performance_MIDI']), pedal_threshold=64),
+    'performance_pianoroll': lambda row: load_pianoroll(os.path.join(row['folder'], row['performance_MIDI']), pedal_threshold=128),
+}
+
+class ParsedFiles(dict):
+    # parsed files of a performance (keys of file_loaders), loaded on first access
+    def __init__(self, row):
+        super().__init__()
+        self.row = row
+
+    def __missing__(self, name):
+        self[name] = file_loaders[name](self.row)
+        return self[name]
+
+def validate_row(row, row_checks):
+    # [(passed, value)] of the checks [(name, check)] on one performance, an exception (e.g. a missing
+    # or broken file) fails the check
+    files = ParsedFiles(row)
+    results = []
+    for name, check in row_checks:
+        try:
+            passed, value = check(row, files)
+        except Exception as e:
+            passed, value = False, 'error: {}: {}'.format(type(e).__name__, e)
+        results.append((bool(passed), value))
+    return results
+
+def run_checks(metadata, names=None, workers=None, chunksize=1):
+    # findings table (performance_id, source, split, check, passed, value) and summary per check
+    check_columns(metadata)
+    names = list(checks.keys()) if names is None else names
+    row_checks = [(name, checks[name][0]) for name in names]
+    print('\nRun {} checks on {} performances.'.format(len(row_checks), len(metadata)))
+    results = metadata_map(functools.partial(validate_row, row_checks=row_checks), metadata, workers=workers, chunksize=chunksize)
+
+    findings = []
+    for row, row_results in zip(metadata.to_dict('records'), results):
+        for name, (passed, value) in zip(names, row_results):
+            findings.append([row['performance_id'], row['source'], row['split'], name, passed, value])
+    findings = pd.DataFrame(findings, columns=['performance_id', 'source', 'split', 'check', 'passed', 'value'])
+
+    summary = {}
+    for name in names:
+        check_findings = findings.loc[findings['check'] == name]
+        summary[name] = {'n_performances': len(check_findings), 'n_failed': int((~check_findings['passed']).sum())}
+        summarize = checks[name][1]
+        if summarize is not None:
+            errors = [isinstance(value, str) for value in check_findings['value']]
+            summary[name].update(summarize(check_findings.loc[~np.array(errors, dtype=bool)]))
+    return findings, summary
+
+def write_report(findings, summary, report_file):
+    # JSON report with the summary and all findings, or a CSV of the findings
+    if report_file.endswith('.csv'):
+        findings.assign(value=[json.dumps(value) for value in findings['value']]).to_csv(report_file, index=False)
+    else:
+        with open(report_file, 'w') as f:
+            json.dump({'summary': summary, 'findings': findings.to_dict('records')}, f, indent=1)
+    print('Written', report_file)
+
+def print_summary(findings, summary):
+    for name, check_summary in summary.items():
+        print('\n{}: {} / {} failed'.format(name, check_summary['n_failed'], check_summary['n_performances']))
+        failed = findings.loc[(findings['check'] == name) & ~findings['passed']]
+        for row in failed.to_dict('records'):
+            print('Nope.', row['performance_id'], 'source:', row['source'], 'split:', row['split'], 'value:', row['value'])
+        for key, value in check_summary.items():
+            if key not in ['n_performances', 'n_failed']:
+                print(key, value)